@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Measure cgroup updates during a boot with the cgroupfs manager, against a
+temporary directory standing in for /sys/fs/cgroup/devices.
+
+Each of C containers boots with N devices, twice, like a container that
+boots again. Once every update is written synchronously on the event loop,
+the way the managers used to, once through ControlGroupManager, which
+deduplicates them and writes them in batches from its thread pool.
+
+usage: python bench/cgroup_updates.py [N [C]]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdev.cgroups
+import cdev.metrics
+
+
+class FakeDevice:
+    def __init__(self, major, minor, subsystem):
+        self.major_minor = major, minor
+        self.subsystem = subsystem
+
+    def get_major_minor(self):
+        return self.major_minor
+
+    def get_subsystem(self):
+        return self.subsystem
+
+
+def make_devices(count):
+    return [FakeDevice(8 + i // 256, i % 256, "block" if i % 2 else "tty") for i in range(count)]
+
+
+def make_cgroups(root, containers):
+    names = ["container%i" % i for i in range(containers)]
+    for name in names:
+        os.makedirs(os.path.join(root, name))
+        for file in ("devices.allow", "devices.deny"):
+            open(os.path.join(root, name, file), "w").close()
+    return names
+
+
+def write_direct(container_name, device):
+    # What a manager without batching does for every event
+    major, minor = device.get_major_minor()
+    type = 'b' if device.get_subsystem() == "block" else 'c'
+    with open(os.path.join(cdev.cgroups.CGROUPFS_PATH % container_name, "devices.allow"), "wb", buffering=0) as f:
+        f.write(("%s %i:%i rwm" % (type, major, minor)).encode())
+
+
+@asyncio.coroutine
+def boot_direct(names, devices):
+    blocked = 0
+    for name in names:
+        start = time.perf_counter()
+        for device in devices:
+            write_direct(name, device)
+        blocked += time.perf_counter() - start
+        yield from asyncio.sleep(0)
+    return blocked
+
+
+@asyncio.coroutine
+def boot_managed(names, devices):
+    manager = cdev.cgroups.ControlGroupManager.get("cgroupfs")
+    blocked = 0
+    for name in names:
+        start = time.perf_counter()
+        for device in devices:
+            manager.allow(name, device)
+        blocked += time.perf_counter() - start
+        yield from asyncio.sleep(0)
+    return blocked
+
+
+def run(loop, label, boot, names, devices):
+    start = time.perf_counter()
+    blocked = loop.run_until_complete(boot(names, devices))
+    blocked += loop.run_until_complete(boot(names, devices))
+    loop.run_until_complete(cdev.cgroups.ControlGroupManager.drain())
+    elapsed = time.perf_counter() - start
+    print("%-8s %8.0f updates/s  loop blocked %6.1f ms" % (label, 2 * len(names) * len(devices) / elapsed, blocked * 1000))
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 2000
+    containers = int(argv[2]) if len(argv) > 2 else 8
+
+    # Don't measure logging
+    cdev.cgroups.logger.disabled = True
+
+    devices = make_devices(count)
+    print("%i devices, %i containers, 2 boots each" % (count, containers))
+
+    loop = asyncio.get_event_loop()
+    with tempfile.TemporaryDirectory() as root:
+        names = make_cgroups(root, containers)
+        cdev.cgroups.CGROUPFS_PATH = os.path.join(root, "%s")
+
+        run(loop, "direct", boot_direct, names, devices)
+        run(loop, "managed", boot_managed, names, devices)
+
+    stats = cdev.metrics.snapshot()
+    print("batches %(cgroups.cgroupfs.batches)i, updates %(cgroups.cgroupfs.updates)i, deduplicated %(cgroups.cgroupfs.deduplicated)i" % stats)
+    print("batch latency %s" % stats["cgroups.cgroupfs.latency"])
+    loop.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Measure the memory footprint of a persistent device registry.
+
+Builds N devices from synthetic libudev netlink messages, the same way cdevd
+does, and reports the traced allocation size per device. The received
+datagrams are allocated up front and not counted.
+
+usage: python bench/device_memory.py [N]
+"""
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdev.device
+import cdev.netlink
+
+
+def make_devpaths(count):
+    """
+    Devices form an 8-ary tree, like sysfs every ancestor is a device, too.
+    """
+    devpaths = ["/devices/pci0000:00"]
+    for i in range(1, count):
+        devpaths.append("%s/sd%i" % (devpaths[(i - 1) // 8], i))
+    return devpaths
+
+
+def make_buffer(i, devpath):
+    props = [
+        ("ACTION", "add"),
+        ("DEVPATH", devpath),
+        ("SUBSYSTEM", "block"),
+        ("DEVNAME", "/dev/sd%i" % i),
+        ("DEVTYPE", "disk"),
+        ("SEQNUM", str(1000 + i)),
+        ("MAJOR", "8"),
+        ("MINOR", str(i % 256)),
+        ("ID_BUS", "usb"),
+        ("ID_SERIAL", "Generic_Flash_Disk_%08X-0:0" % i),
+        ("ID_TYPE", "disk"),
+        ("USEC_INITIALIZED", "12345678"),
+    ]
+    message = cdev.netlink.UdevNetlinkMessage(props=dict(props))
+    return message.pack()
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+
+    buffers = [make_buffer(i, devpath) for i, devpath in enumerate(make_devpaths(count))]
+
+    cdev.device.Device.enable_persistent_registry()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    for buffer in buffers:
+        cdev.netlink.UdevNetlinkMessage.parse(buffer).make_device()
+
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    print("%i devices: %.1f MiB total, %i bytes per device" % (count, size / 1048576, size // count))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Compare fanning out events to several clients over their sockets with
+sharing them through an EventRing.
+
+For each of N events, the server side either writes a full UEVENT message to
+each of C clients' sockets, or puts the event into the ring once and writes a
+UEVENTR reference to each socket. Each client reads its socket in a thread and
+copies events out of the ring where needed.
+
+usage: python bench/event_ring.py [N [C]]
+"""
+
+import os
+import sys
+import time
+import socket
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdev.netlink
+import cdev.protocol
+import cdev.ring
+
+
+def make_events(count):
+    events = []
+    for i in range(count):
+        event = cdev.netlink.UdevNetlinkMessage(props={
+            "ACTION": "change",
+            "DEVPATH": "/devices/pci0000:00/0000:00:14.0/usb1/1-%i/1-%i:1.0/host%i/target%i:0:0/%i:0:0:0/block/sd%i" % (i, i, i, i, i, i),
+            "SUBSYSTEM": "block",
+            "DEVNAME": "/dev/sd%i" % i,
+            "DEVTYPE": "disk",
+            "SEQNUM": str(1000 + i),
+            "MAJOR": "8",
+            "MINOR": str(i % 256),
+            "ID_SERIAL": "Generic_Flash_Disk_%08X-0:0" % i,
+            "ID_FS_UUID": "%08x-1234-5678-9abc-def012345678" % i,
+        })
+        events.append(event.pack())
+    return events
+
+
+def reader(sock, count, ring_path, result):
+    ring = cdev.ring.EventRing.open(ring_path) if ring_path else None
+    f = sock.makefile("rb")
+    received = 0
+    for i in range(count):
+        command, type, size = cdev.protocol.unpack_header(f.read(20))
+        data = f.read(size)
+        if command == b"UEVENTR":
+            data = ring.get(*cdev.ring.RING_REF.unpack(data))
+        received += len(data)
+    result.append(received)
+    f.close()
+    if ring:
+        ring.close()
+
+
+def run(name, events, clients, ring):
+    socks = [socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM) for i in range(clients)]
+    results = []
+    threads = [threading.Thread(target=reader, args=(r, len(events), ring and ring.path, results)) for w, r in socks]
+    for thread in threads:
+        thread.start()
+
+    sent = 0
+    start = time.perf_counter()
+    for event in events:
+        if ring:
+            message = cdev.protocol.Message(b"UEVENTR", cdev.protocol.D_DATA,
+                                            cdev.ring.RING_REF.pack(ring.put_once(event), len(event))).pack()
+        else:
+            message = cdev.protocol.Message(b"UEVENT", cdev.protocol.D_DATA, event).pack()
+        for w, r in socks:
+            w.sendall(message)
+            sent += len(message)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    for w, r in socks:
+        w.close()
+        r.close()
+
+    assert results == [sum(map(len, events))] * clients
+    print("%-8s %8.0f events/s  %9i socket bytes (%i per event and client)" % (name, len(events) / elapsed, sent, sent // (len(events) * clients)))
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 20000
+    clients = int(argv[2]) if len(argv) > 2 else 8
+
+    events = make_events(count)
+    print("%i events, %i bytes each, %i clients" % (count, len(events[0]), clients))
+
+    run("socket", events, clients, None)
+    with tempfile.TemporaryDirectory() as tmp:
+        ring = cdev.ring.EventRing.create(os.path.join(tmp, "events.ring"), 16 * 1024 * 1024)
+        run("ring", events, clients, ring)
+        ring.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Measure the cost of the libudev header hashes.
+
+Compares the uncached pure-python MurmurHash2 with the cached string_hash32
+for per-event header generation, the cached per-device tag bloom with
+rehashing all tags, and the numpy batch API with hashing one by one.
+
+usage: python bench/hashing.py [N]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdev.device
+import cdev.murmurhash2 as murmurhash2
+
+SUBSYSTEMS = ["block", "usb", "net", "input", "tty", "sound", "pci", "scsi", "hidraw", "drm"]
+DEVTYPES = ["disk", "partition", "usb_device", "usb_interface", "wlan", None]
+TAGS = ["seat", "uaccess", "systemd", "power-switch"]
+
+
+def bench(name, func, count):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print("%-24s %8.1f ms  %6.2f us/op" % (name, elapsed * 1000, elapsed / count * 1e6))
+
+
+def make_devices(count):
+    devices = []
+    for i in range(count):
+        device = cdev.device.Device()
+        device.devpath = "/devices/virtual/bench/dev%i" % i
+        device.subsystem = SUBSYSTEMS[i % len(SUBSYSTEMS)]
+        device.devtype = DEVTYPES[i % len(DEVTYPES)]
+        device.is_db_loaded = True
+        device.tags.update(TAGS[:i % len(TAGS)])
+        devices.append(device)
+    return devices
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    devices = make_devices(count)
+
+    def uncached_hashes():
+        for device in devices:
+            murmurhash2.MurmurHash2(device.subsystem.encode())
+            if device.devtype is not None:
+                murmurhash2.MurmurHash2(device.devtype.encode())
+
+    def cached_hashes():
+        for device in devices:
+            murmurhash2.string_hash32(device.subsystem)
+            if device.devtype is not None:
+                murmurhash2.string_hash32(device.devtype)
+
+    def uncached_bloom():
+        for device in devices:
+            bloom = 0
+            for tag in device.tags:
+                bloom |= murmurhash2.util_string_bloom64(tag.encode())
+
+    def cached_bloom():
+        for device in devices:
+            device.get_tag_bloom()
+
+    bench("hashes uncached", uncached_hashes, count)
+    bench("hashes cached", cached_hashes, count)
+    bench("tag bloom uncached", uncached_bloom, count)
+    cached_bloom()
+    bench("tag bloom cached", cached_bloom, count)
+
+    # The batch API is meant for many distinct short strings, e.g. cold caches at boot
+    strings = [("%s/%i" % (SUBSYSTEMS[i % len(SUBSYSTEMS)], i)).encode() for i in range(count)]
+    bench("batch one by one", lambda: [murmurhash2.MurmurHash2(s) for s in strings], count)
+    if murmurhash2.numpy is not None:
+        bench("batch numpy", lambda: murmurhash2.MurmurHash2_many(strings), count)
+    else:
+        print("batch numpy              (numpy not available)")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Compare encodings of SYNC payloads: cdev.schema (D_SCHM), JSON, pickle and
+the E:/G: line buffer.
+
+Reports encode and decode time and the payload size, per SYNC message.
+
+usage: python bench/payload_encoding.py [N]
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdev.schema
+
+
+def make_sync(i):
+    env = {
+        "ID_BUS": "usb",
+        "ID_MODEL": "Flash_Disk",
+        "ID_MODEL_ENC": "Flash\\x20Disk",
+        "ID_MODEL_ID": "6387",
+        "ID_VENDOR": "Generic",
+        "ID_VENDOR_ID": "058f",
+        "ID_SERIAL": "Generic_Flash_Disk_%08X-0:0" % i,
+        "ID_SERIAL_SHORT": "%08X" % i,
+        "ID_REVISION": "8.07",
+        "ID_TYPE": "disk",
+        "ID_INSTANCE": "0:0",
+        "ID_PATH": "pci-0000:00:14.0-usb-0:%i:1.0-scsi-0:0:0:0" % i,
+        "ID_PATH_TAG": "pci-0000_00_14_0-usb-0_%i_1_0-scsi-0_0_0_0" % i,
+        "ID_USB_DRIVER": "usb-storage",
+        "ID_USB_INTERFACES": ":080650:",
+        "ID_PART_TABLE_TYPE": "dos",
+        "ID_PART_TABLE_UUID": "%08x" % i,
+        "DEVLINKS": "/dev/disk/by-id/usb-Generic_Flash_Disk_%08X-0:0" % i,
+        "USEC_INITIALIZED": "12345678",
+        "UDISKS_AUTO": "1", # not in the key table
+    }
+    return {"devpath": "/devices/pci0000:00/0000:00:14.0/usb1/1-%i/1-%i:1.0/host%i/target%i:0:0/%i:0:0:0/block/sd%i" % (i, i, i, i, i, i),
+            "props": "EG", "env": env, "tags": ["systemd", "uaccess"], "version": i + 1}
+
+
+def lines_encode(values):
+    sync = ["E:%s=%s" % item for item in values["env"].items()]
+    sync.extend("G:%s" % tag for tag in values["tags"])
+    return b"\0".join((values["devpath"].encode(), values["props"].encode(), "\n".join(sync).encode()))
+
+def lines_decode(data):
+    devpath, props, buffer = data.split(b"\0", 2)
+    env = {}
+    tags = []
+    for line in buffer.splitlines():
+        if line[0] in b"E":
+            k, v = line[2:].decode().split("=", 1)
+            env[k] = v
+        elif line[0] in b"G":
+            tags.append(line[2:].decode())
+    return {"devpath": devpath.decode(), "props": props.decode(), "env": env, "tags": tags}
+
+
+def measure(name, encode, decode, payloads):
+    start = time.perf_counter()
+    encoded = [encode(values) for values in payloads]
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for data in encoded:
+        decode(data)
+    decode_time = time.perf_counter() - start
+
+    count = len(payloads)
+    size = sum(map(len, encoded)) // count
+    print("%-8s encode %6.2f us  decode %6.2f us  %5i bytes" % (name, encode_time / count * 1e6, decode_time / count * 1e6, size))
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    payloads = [make_sync(i) for i in range(count)]
+
+    codec = cdev.schema.Codec()
+    assert codec.decode(codec.encode(cdev.schema.SYNC, payloads[0]))[1] == payloads[0]
+
+    measure("schema", lambda values: codec.encode(cdev.schema.SYNC, values), codec.decode, payloads)
+    measure("json", lambda values: json.dumps(values).encode(), lambda data: json.loads(data.decode()), payloads)
+    measure("pickle", lambda values: pickle.dumps(values, pickle.HIGHEST_PROTOCOL), pickle.loads, payloads)
+    measure("lines", lines_encode, lines_decode, payloads)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Measure cdev protocol receive throughput over a local socketpair.
+
+A thread writes N packed UEVENT messages into one end, the event loop reads
+them from the other, once one message at a time with recv_message() in a
+new Task per message, like the daemons used to, and once with MessageReader.
+
+usage: python bench/protocol_reader.py [N]
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdev.asyncio
+import cdev.netlink
+import cdev.protocol
+
+
+def make_stream(count):
+    messages = []
+    for i in range(count):
+        event = cdev.netlink.UdevNetlinkMessage(props={
+            "ACTION": "add",
+            "DEVPATH": "/devices/pci0000:00/0000:00:14.0/usb1/1-%i/1-%i:1.0/host%i/target%i:0:0/%i:0:0:0/block/sd%i" % (i, i, i, i, i, i),
+            "SUBSYSTEM": "block",
+            "DEVNAME": "/dev/sd%i" % i,
+            "DEVTYPE": "disk",
+            "SEQNUM": str(1000 + i),
+            "MAJOR": "8",
+            "MINOR": str(i % 256),
+        })
+        messages.append(cdev.protocol.Message(b"UEVENT", cdev.protocol.D_DATA, event.pack()).pack())
+    return b"".join(messages)
+
+
+def writer(sock, data):
+    sock.sendall(data)
+    sock.close()
+
+
+@asyncio.coroutine
+def read_single(stream_reader, count):
+    for i in range(count):
+        yield from asyncio.Task(cdev.asyncio.recv_message(stream_reader))
+
+@asyncio.coroutine
+def read_batched(stream_reader, count):
+    reader = cdev.asyncio.MessageReader(stream_reader)
+    while count > 0:
+        messages = yield from asyncio.Task(reader.recv_batch())
+        count -= len(messages)
+
+
+def run(loop, name, consumer, data, count):
+    rsock, wsock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    stream_reader, stream_writer = loop.run_until_complete(asyncio.open_unix_connection(sock=rsock))
+
+    thread = threading.Thread(target=writer, args=(wsock, data))
+    start = time.perf_counter()
+    thread.start()
+    loop.run_until_complete(consumer(stream_reader, count))
+    elapsed = time.perf_counter() - start
+    thread.join()
+
+    stream_writer.close()
+
+    print("%-8s %8.0f msg/s  %7.1f MiB/s" % (name, count / elapsed, len(data) / elapsed / 1048576))
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+
+    data = make_stream(count)
+    print("%i messages, %i bytes each" % (count, len(data) // count))
+
+    loop = asyncio.get_event_loop()
+    run(loop, "single", read_single, data, count)
+    run(loop, "batched", read_batched, data, count)
+    loop.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Compare cdev.struct with plain struct.Struct on the libudev message header.
+
+usage: python bench/struct_header.py [N]
+"""
+
+import os
+import sys
+import struct
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdev.netlink
+
+Header = cdev.netlink.UdevNetlinkHeader
+
+# The same layout as three plain structs
+parts = tuple(struct.Struct(format) for format in Header.formats)
+
+
+def plain_unpack(buffer):
+    return parts[0].unpack_from(buffer, 0) + parts[1].unpack_from(buffer, 12) + parts[2].unpack_from(buffer, 24)
+
+def plain_pack_into(buffer, values):
+    parts[0].pack_into(buffer, 0, *values[0:2])
+    parts[1].pack_into(buffer, 12, *values[2:5])
+    parts[2].pack_into(buffer, 24, *values[5:9])
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 1000000
+
+    header = Header.new()
+    header.properties_len = 123
+    buffer = header.pack()
+    values = plain_unpack(buffer)
+    target = bytearray(Header.size)
+
+    cases = [
+        ("struct.Struct unpack", lambda: plain_unpack(buffer)),
+        ("Header.unpack_from", lambda: Header.unpack_from(buffer)),
+        ("struct.Struct pack_into", lambda: plain_pack_into(target, values)),
+        ("Header.pack_into", lambda: header.pack_into(target)),
+        ("Header.pack", header.pack),
+        ("tuple index", lambda: values[4]),
+        ("field get", lambda: header.properties_len),
+    ]
+
+    def set_field():
+        header.properties_len = 123
+    cases.append(("field set", set_field))
+
+    for name, func in cases:
+        elapsed = min(timeit.repeat(func, number=count, repeat=3))
+        print("%-24s %6.1f ns/op" % (name, elapsed / count * 1e9))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -20,8 +20,11 @@
 
 import asyncio
 import socket
+import errno
+import collections
 import concurrent.futures
 from . import protocol
+from . import metrics
 
 def _sock_recvmsg(sock, bufsize, ancbufsize, flags, future, registered=False):
     fd = sock.fileno()
@@ -44,18 +47,503 @@ def sock_recvmsg(socket, bufsize, ancbufsize=0, flags=0):
     _sock_recvmsg(socket, bufsize, ancbufsize, flags, future)
     return (yield from asyncio.wait_for(future, None))
 
+class DatagramSource:
+    """
+    Receive batches of datagrams from a socket.
+
+    Unlike sock_recvmsg(), the reader is registered with the event loop once and
+    every readiness notification drains all pending datagrams into a batch.
+
+    When more than max_pending datagrams are waiting to be consumed, the reader is
+    paused until the consumer catches up, leaving the rest in the socket buffer.
+
+    ENOBUFS (netlink receive buffer overflow) doesn't end the stream. Instead, the
+    overflowed flag is set and recv_batch() returns, so the consumer can resync.
+
+    On connection-oriented sockets (SOCK_SEQPACKET), pass eof_on_empty=True to
+    have an empty read raise EOFError instead of returning empty datagrams.
+    """
+    def __init__(self, sock, bufsize, ancbufsize=0, *, name="datagrams", max_pending=8192, eof_on_empty=False, loop=None):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.ancbufsize = ancbufsize
+        self.max_pending = max_pending
+        self.eof_on_empty = eof_on_empty
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self.pending = []
+        self.exception = None
+        self.overflowed = False
+        self.waiter = None
+        self.reading = False
+
+        self.batch_size = metrics.summary(name + ".batch_size")
+        self.paused = metrics.counter(name + ".paused")
+        self.overflows = metrics.counter(name + ".overflows")
+
+        sock.setblocking(False)
+        self.resume_reading()
+
+    def pause_reading(self):
+        if self.reading:
+            self.loop.remove_reader(self.sock.fileno())
+            self.reading = False
+            self.paused.inc()
+
+    def resume_reading(self):
+        if not self.reading:
+            self.loop.add_reader(self.sock.fileno(), self._read_ready)
+            self.reading = True
+
+    def close(self):
+        self.pause_reading()
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.cancel()
+
+    def _read_ready(self):
+        sock = self.sock
+        pending = self.pending
+        count = 0
+        while len(pending) < self.max_pending:
+            try:
+                msg = sock.recvmsg(self.bufsize, self.ancbufsize)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    # The kernel dropped datagrams, but the socket remains usable
+                    self.overflowed = True
+                    self.overflows.inc()
+                    continue
+                self.exception = e
+                break
+            except Exception as e:
+                self.exception = e
+                break
+            if self.eof_on_empty and not msg[0]:
+                self.exception = EOFError()
+                self.pause_reading()
+                break
+            pending.append(msg)
+            count += 1
+        else:
+            self.pause_reading()
+
+        if count:
+            self.batch_size.observe(count)
+
+        if (pending or self.overflowed or self.exception is not None) and self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    @asyncio.coroutine
+    def recv_batch(self):
+        """
+        Wait for datagrams and return all that are pending.
+
+        Returns a list of recvmsg() results, possibly empty if only the overflowed flag was set.
+        Socket errors are raised once the datagrams received before them are consumed.
+        """
+        while not self.pending and not self.overflowed:
+            if self.exception is not None:
+                exc, self.exception = self.exception, None
+                raise exc
+            self.waiter = self.loop.create_future()
+            try:
+                yield from self.waiter
+            finally:
+                self.waiter = None
+
+        batch, self.pending = self.pending, []
+        self.resume_reading()
+        return batch
+
+
+class PacketWriter:
+    """
+    Non-blocking sendmsg() on a datagram or seqpacket socket.
+
+    Packets that can't be sent right away are kept in a backlog and sent once
+    the socket becomes writable. Beyond max_pending packets, droppable ones are
+    discarded and on_overflow() is called once the backlog has been sent.
+
+    callback() is called once a packet was sent or discarded, e.g. to close passed fds.
+    """
+    def __init__(self, sock, *, name="packets", max_pending=65536, on_overflow=None, loop=None):
+        self.sock = sock
+        self.max_pending = max_pending
+        self.on_overflow = on_overflow
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self.pending = collections.deque() # (data, ancdata, callback)
+        self.overflowed = False
+        self.writing = False
+        self.exception = None
+
+        self.name = name
+        metrics.gauge(name + ".pending", lambda: len(self.pending))
+        self.overflows = metrics.counter(name + ".overflows")
+
+        sock.setblocking(False)
+
+    def send(self, data, ancdata=(), *, droppable=False, callback=None):
+        """
+        Send or queue a packet. Returns False if it was discarded.
+        """
+        if self.exception is None and not self.pending:
+            try:
+                self.sock.sendmsg((data,), ancdata)
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError as e:
+                self.exception = e
+            else:
+                if callback is not None:
+                    callback()
+                return True
+
+        if self.exception is not None or (droppable and len(self.pending) >= self.max_pending):
+            if self.exception is None and not self.overflowed:
+                self.overflowed = True
+                self.overflows.inc()
+            if callback is not None:
+                callback()
+            return False
+
+        self.pending.append((data, ancdata, callback))
+        if not self.writing:
+            self.loop.add_writer(self.sock.fileno(), self._write_ready)
+            self.writing = True
+        return True
+
+    def _write_ready(self):
+        pending = self.pending
+        while pending:
+            data, ancdata, callback = pending[0]
+            try:
+                self.sock.sendmsg((data,), ancdata)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.exception = e
+                self._discard()
+                break
+            pending.popleft()
+            if callback is not None:
+                callback()
+
+        self.loop.remove_writer(self.sock.fileno())
+        self.writing = False
+
+        if self.overflowed and self.exception is None:
+            self.overflowed = False
+            if self.on_overflow is not None:
+                self.on_overflow()
+
+    def _discard(self):
+        while self.pending:
+            callback = self.pending.popleft()[2]
+            if callback is not None:
+                callback()
+
+    @asyncio.coroutine
+    def flush(self, interval=0.01):
+        """
+        Wait until the backlog has been sent
+        """
+        while self.pending and self.exception is None:
+            yield from asyncio.sleep(interval)
+
+    def close(self):
+        if self.writing:
+            self.loop.remove_writer(self.sock.fileno())
+            self.writing = False
+        self._discard()
+        metrics.remove(self.name + ".pending")
+
+
+class _Hold:
+    """
+    A queue entry that holds back the messages after it until future is done
+    """
+    __slots__ = ("future",)
+
+    def __init__(self, future):
+        self.future = future
+
+    def __len__(self):
+        return 0
+
+
+class MessageQueue:
+    """
+    A bounded outbound queue of packed messages in front of a StreamWriter.
+
+    A writer task sends one message at a time and waits on drain(), so the
+    transport buffer stays between the low and high water marks, and
+    everything else waits here, within max_bytes and max_messages.
+
+    Messages are put with a collapse key and a droppable flag. When the limits
+    are exceeded, older messages with the same key as a newer one are dropped
+    first. If that's not enough, all droppable messages are dropped and the
+    overflowed flag is set; on_overflow() is called once the queue ran empty,
+    so the owner can resynchronize the peer.
+
+    If batch is set, runs of batchable messages that piled up while the writer
+    waited are joined with batch(buffers) into one message of up to about
+    batch_bytes.
+
+    hold(future) keeps the messages put after it from being sent before the
+    future is done.
+    """
+    def __init__(self, writer, *, name="queue", max_bytes=16*1024*1024, max_messages=65536,
+                 high_water=256*1024, low_water=64*1024, on_overflow=None, batch=None, batch_bytes=64*1024, loop=None):
+        self.writer = writer
+        self.batch = batch
+        self.batch_bytes = batch_bytes
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.on_overflow = on_overflow
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self.pending = collections.deque() # (buffer, key, droppable, batchable)
+        self.bytes = 0
+        self.overflowed = False
+        self.closed = False
+        self.waiter = None # the writer task waits for messages
+        self.writable = None # producers wait for space
+
+        self.name = name
+        metrics.gauge(name + ".bytes", lambda: self.bytes)
+        metrics.gauge(name + ".messages", lambda: len(self.pending))
+        self.collapsed = metrics.counter("queues.collapsed")
+        self.overflows = metrics.counter("queues.overflows")
+        self.batches = metrics.counter("queues.batches")
+        self.batched = metrics.counter("queues.batched")
+
+        if writer.transport is not None:
+            writer.transport.set_write_buffer_limits(high_water, low_water)
+
+        self.task = asyncio.ensure_future(self.run(), loop=self.loop)
+
+    def put(self, buffer, key=None, droppable=False, batchable=False):
+        """
+        Queue a packed message
+        """
+        if self.closed:
+            return
+
+        self.pending.append((buffer, key, droppable, batchable))
+        self.bytes += len(buffer)
+
+        if self.bytes > self.max_bytes or len(self.pending) > self.max_messages:
+            self.collapse()
+            if self.bytes > self.max_bytes or len(self.pending) > self.max_messages:
+                self.overflow()
+
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def hold(self, future):
+        """
+        Send the messages put from now on only once future is done
+        """
+        if self.closed or future.done():
+            return
+
+        self.pending.append((_Hold(future), None, False, False))
+
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def collapse(self):
+        """
+        Drop messages superseded by a newer one with the same key
+        """
+        seen = set()
+        kept = collections.deque()
+        for entry in reversed(self.pending):
+            key = entry[1]
+            if key is not None:
+                if key in seen:
+                    self.bytes -= len(entry[0])
+                    self.collapsed.inc()
+                    continue
+                seen.add(key)
+            kept.appendleft(entry)
+        self.pending = kept
+
+    def overflow(self):
+        """
+        Drop all droppable messages
+        """
+        self.pending = collections.deque(entry for entry in self.pending if not entry[2])
+        self.bytes = sum(len(entry[0]) for entry in self.pending)
+        if not self.overflowed:
+            self.overflowed = True
+            self.overflows.inc()
+
+    def is_writable(self):
+        return self.bytes <= self.max_bytes // 2 and len(self.pending) <= self.max_messages // 2
+
+    @asyncio.coroutine
+    def wait_writable(self):
+        """
+        Wait until the queue is at most half full, for producers that can wait
+        """
+        while not self.is_writable() and not self.task.done():
+            if self.writable is None or self.writable.done():
+                self.writable = self.loop.create_future()
+            yield from asyncio.shield(self.writable)
+
+    def _notify_writable(self):
+        if self.writable is not None and not self.writable.done() and self.is_writable():
+            self.writable.set_result(None)
+
+    def close(self):
+        """
+        Stop accepting messages. The writer task ends once the queue is flushed.
+        """
+        self.closed = True
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+        metrics.remove(self.name + ".bytes")
+        metrics.remove(self.name + ".messages")
+
+    @asyncio.coroutine
+    def run(self):
+        try:
+            while True:
+                while not self.pending:
+                    if self.overflowed:
+                        self.overflowed = False
+                        if self.on_overflow is not None:
+                            self.on_overflow()
+                        continue
+                    if self.closed:
+                        return
+                    self.waiter = self.loop.create_future()
+                    try:
+                        yield from self.waiter
+                    finally:
+                        self.waiter = None
+
+                buffer, key, droppable, batchable = self.pending.popleft()
+                self.bytes -= len(buffer)
+
+                if type(buffer) is _Hold:
+                    if not buffer.future.done():
+                        yield from asyncio.wait([buffer.future])
+                    continue
+
+                if batchable and self.batch is not None and self.pending and self.pending[0][3]:
+                    buffers = [buffer]
+                    size = len(buffer)
+                    while self.pending and self.pending[0][3] and size < self.batch_bytes:
+                        buffer = self.pending.popleft()[0]
+                        self.bytes -= len(buffer)
+                        buffers.append(buffer)
+                        size += len(buffer)
+                    buffer = self.batch(buffers)
+                    self.batches.inc()
+                    self.batched.inc(len(buffers))
+
+                self._notify_writable()
+
+                self.writer.write(buffer)
+                yield from self.writer.drain()
+        finally:
+            if self.writable is not None and not self.writable.done():
+                self.writable.set_result(None)
+
+
+class MessageReader:
+    """
+    Buffered decoder for cdev.protocol messages from a StreamReader.
+
+    Reads whatever is available, up to read_size, and parses all complete
+    messages in it at once. Headers are parsed in place and payloads are
+    sliced out of the buffer through a memoryview. Raises EOFError when the
+    connection is closed.
+    """
+    read_size = 256 * 1024
+
+    def __init__(self, stream_reader):
+        self.reader = stream_reader
+        self.buffer = b""
+        self.messages = collections.deque()
+
+    def feed(self, data):
+        """
+        Parse the complete messages in the buffer plus data
+        """
+        if self.buffer:
+            data = self.buffer + data
+        view = memoryview(data)
+        end = len(data)
+        offset = 0
+
+        while end - offset >= 20:
+            command, type, size = protocol.unpack_header(view, offset)
+            start = offset + 20
+            if end - start < size:
+                break
+            payload, fmt = protocol.deserialize_data(type, view[start:start+size])
+            self.messages.append(protocol.Message(command, type, payload, fmt))
+            offset = start + size
+
+        self.buffer = data[offset:]
+
+    @asyncio.coroutine
+    def fill(self):
+        while not self.messages:
+            data = yield from self.reader.read(self.read_size)
+            if not data:
+                raise EOFError("Connection closed" if not self.buffer else "Connection closed in the middle of a message")
+            self.feed(data)
+
+            # Read the rest of a big message at once instead of growing the buffer piecewise
+            if len(self.buffer) >= 20:
+                missing = 20 + protocol.unpack_header(self.buffer)[2] - len(self.buffer)
+                if missing > self.read_size:
+                    try:
+                        data = yield from self.reader.readexactly(missing)
+                    except asyncio.IncompleteReadError:
+                        raise EOFError("Connection closed in the middle of a message")
+                    self.feed(data)
+
+    @asyncio.coroutine
+    def recv(self):
+        """
+        Receive the next message
+        """
+        if not self.messages:
+            yield from self.fill()
+        return self.messages.popleft()
+
+    @asyncio.coroutine
+    def recv_batch(self):
+        """
+        Receive all messages that are available, at least one
+        """
+        if not self.messages:
+            yield from self.fill()
+        messages = list(self.messages)
+        self.messages.clear()
+        return messages
+
+
 @asyncio.coroutine
 def recv_message(stream_reader):
-    command, type, size = protocol.unpack_header((yield from stream_reader.read(20)))
-    data, fmt = protocol.deserialize_data(type, (yield from stream_reader.read(size)))
+    command, type, size = protocol.unpack_header((yield from stream_reader.readexactly(20)))
+    data, fmt = protocol.deserialize_data(type, (yield from stream_reader.readexactly(size)))
     return protocol.Message(command, type, data, fmt)
 
 @asyncio.coroutine
 def recv_message_timeout(stream_reader, timeout=10.0):
     try:
-        data = yield from asyncio.wait_for(stream_reader.read(20), timeout=timeout)
+        data = yield from asyncio.wait_for(stream_reader.readexactly(20), timeout=timeout)
     except concurrent.futures.TimeoutError:
         return None
     command, type, size = protocol.unpack_header(data)
-    data, fmt = protocol.deserialize_data(type, (yield from stream_reader.read(size)))
+    data, fmt = protocol.deserialize_data(type, (yield from stream_reader.readexactly(size)))
     return protocol.Message(command, type, data, fmt)
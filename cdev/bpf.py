@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Classic BPF socket filters
+
+Build a program with Program, then attach it to a socket:
+
+    prog = Program()
+    prog.stmt(BPF_LD|BPF_W|BPF_ABS, 0)
+    prog.jump(BPF_JMP|BPF_JEQ|BPF_K, 0xfeedcafe, 0, 1)
+    prog.stmt(BPF_RET|BPF_K, PASS)
+    prog.stmt(BPF_RET|BPF_K, DROP)
+    attach_filter(sock, prog)
+"""
+
+import ctypes
+from . import socket
+
+# Instruction classes (from linux/filter.h)
+BPF_LD   = 0x00
+BPF_LDX  = 0x01
+BPF_ST   = 0x02
+BPF_STX  = 0x03
+BPF_ALU  = 0x04
+BPF_JMP  = 0x05
+BPF_RET  = 0x06
+BPF_MISC = 0x07
+
+# ld/ldx fields
+BPF_W    = 0x00
+BPF_H    = 0x08
+BPF_B    = 0x10
+BPF_IMM  = 0x00
+BPF_ABS  = 0x20
+BPF_IND  = 0x40
+BPF_MEM  = 0x60
+BPF_LEN  = 0x80
+BPF_MSH  = 0xa0
+
+# alu/jmp fields
+BPF_ADD  = 0x00
+BPF_SUB  = 0x10
+BPF_MUL  = 0x20
+BPF_DIV  = 0x30
+BPF_OR   = 0x40
+BPF_AND  = 0x50
+BPF_LSH  = 0x60
+BPF_RSH  = 0x70
+BPF_NEG  = 0x80
+BPF_JA   = 0x00
+BPF_JEQ  = 0x10
+BPF_JGT  = 0x20
+BPF_JGE  = 0x30
+BPF_JSET = 0x40
+BPF_K    = 0x00
+BPF_X    = 0x08
+
+BPF_MAXINSNS = 4096
+
+# Return values
+PASS = 0xffffffff
+DROP = 0
+
+# Socket options (from asm-generic/socket.h)
+SO_ATTACH_FILTER = 26
+SO_DETACH_FILTER = 27
+
+
+class sock_filter(ctypes.Structure):
+    _fields_ = [
+        ("code", ctypes.c_uint16),
+        ("jt", ctypes.c_uint8),
+        ("jf", ctypes.c_uint8),
+        ("k", ctypes.c_uint32),
+    ]
+
+
+class sock_fprog(ctypes.Structure):
+    _fields_ = [
+        ("len", ctypes.c_ushort),
+        ("filter", ctypes.POINTER(sock_filter)),
+    ]
+
+
+class Program(list):
+    """
+    A list of (code, jt, jf, k) instructions
+    """
+    __slots__ = ()
+
+    def stmt(self, code, k):
+        self.append((code, 0, 0, k))
+
+    def jump(self, code, k, jt, jf):
+        self.append((code, jt, jf, k))
+
+    def compile(self):
+        """
+        Returns a sock_fprog. Keep it alive for as long as it's used!
+        """
+        if len(self) > BPF_MAXINSNS:
+            raise ValueError("BPF program too long: %i instructions" % len(self))
+        insns = (sock_filter * len(self))(*(sock_filter(*insn) for insn in self))
+        prog = sock_fprog(len(self), insns)
+        prog._insns = insns
+        return prog
+
+
+def attach_filter(sock, program):
+    """
+    Attach a Program to sock, replacing any previous filter
+    """
+    prog = program.compile()
+    # The kernel copies the program during setsockopt(), so the buffers only need to live until then.
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, bytes(prog))
+
+def detach_filter(sock):
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
+    except OSError:
+        pass # no filter attached
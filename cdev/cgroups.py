@@ -20,52 +20,266 @@
 
 """
 Interact with container managers to modify the control group
+
+Updates are deduplicated per container and device, collected while the event
+loop is busy and then applied in batches from a thread pool, so a slow
+container manager doesn't hold up event handling. A container's batches are
+applied one after the other, in order.
+
+allow() and deny() return a future that's done once the update is applied,
+or None if it already is. Failed batches are retried a few times.
 """
 
+import os
+import time
+import asyncio
 import logging
+import functools
+import collections
+import concurrent.futures
+
+from . import metrics
 
 logger = logging.getLogger(__name__)
 
+# Where the cgroupfs manager finds a container's devices cgroup, by container name
+CGROUPFS_PATH = "/sys/fs/cgroup/devices/lxc/%s"
+
+
 # Define a convenience class :)
 class ControlGroupManager:
     registry = {}
 
+    executor = None # shared by all managers, see get_executor()
+    max_workers = 4
+    inflight = set() # futures of the batches being applied
+
+    max_attempts = 3
+    retry_delay = 1.0
+
     def __init__(self, name):
         self.name = name
         self.registry[name] = self
 
+        self.state = {} # container -> {(type, major, minor): (file, rule)} last requested
+        self.pending = {} # container -> OrderedDict of key -> (update, waiter, attempts), not applied yet
+        self.waiters = {} # container -> {key: future} of the updates not applied yet
+        self.busy = set() # containers with a batch being applied
+        self.scheduled = False
+
+        self.latency = metrics.summary("cgroups.%s.latency" % name)
+        self.updates = metrics.counter("cgroups.%s.updates" % name)
+        self.deduplicated = metrics.counter("cgroups.%s.deduplicated" % name)
+        self.batches = metrics.counter("cgroups.%s.batches" % name)
+        self.errors = metrics.counter("cgroups.%s.errors" % name)
+        self.retries = metrics.counter("cgroups.%s.retries" % name)
+
     def __call__(self, func):
+        """
+        Register the function that applies a batch of updates to a container,
+        func(container_name, updates) with updates a list of (file, rule) like
+        ("devices.allow", "c 189:1 rwm"). It's called in a worker thread.
+        """
         self.func = func
         return func # Even though it's not really useful.
 
     def allow(self, container_name, device):
-        self.func(container_name, device, True)
+        return self.update(container_name, device, True)
 
     def deny(self, container_name, device):
-        self.func(container_name, device, False)
+        return self.update(container_name, device, False)
+
+    def deny_all(self, container_name, devices):
+        for device in devices:
+            self.update(container_name, device, False)
+
+    def update(self, container_name, device, allow):
+        """
+        Returns a future that's done once the update is applied, or None
+        """
+        major, minor = device.get_major_minor()
+        if not major:
+            return None
+
+        key = ('b' if device.get_subsystem() == "block" else 'c', major, minor)
+        if allow:
+            update = ("devices.allow", "%s %i:%i rwm" % key)
+        else:
+            update = ("devices.deny", "%s %i:%i rm" % key)
+
+        state = self.state.setdefault(container_name, {})
+        waiters = self.waiters.setdefault(container_name, {})
+        if state.get(key) == update:
+            self.deduplicated.inc()
+            return waiters.get(key) # it may still be on its way
+        state[key] = update
+
+        logger.info("Adding cgroups rule to %s container %s: %s = %s" % (self.name, container_name, update[0], update[1]))
+
+        # A newer update for the same device replaces a pending one, and whoever waits for it
+        pending = self.pending.setdefault(container_name, collections.OrderedDict())
+        if key in pending:
+            waiter = pending[key][1]
+        else:
+            waiter = waiters[key] = asyncio.get_event_loop().create_future()
+        pending[key] = (update, waiter, 0)
+
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_event_loop().call_soon(self.flush)
+        return waiter
+
+    def forget(self, container_name):
+        """
+        Forget what we applied to a container, e.g. because it may have been restarted
+        """
+        self.state.pop(container_name, None)
+
+    def flush(self):
+        """
+        Start applying the pending updates of the containers that aren't busy
+        """
+        self.scheduled = False
+        loop = asyncio.get_event_loop()
+        for container_name in list(self.pending):
+            if container_name in self.busy:
+                continue # applied() comes back for them
+            batch = list(self.pending.pop(container_name).items())
+            updates = [entry[0] for key, entry in batch]
+            self.busy.add(container_name)
+            future = loop.run_in_executor(self.get_executor(), self.apply, container_name, updates)
+            self.inflight.add(future)
+            future.add_done_callback(functools.partial(self.applied, container_name, batch))
+
+    def apply(self, container_name, updates):
+        """
+        Runs in a worker thread, returns how long it took
+        """
+        start = time.monotonic()
+        self.func(container_name, updates)
+        return time.monotonic() - start
+
+    def applied(self, container_name, batch, future):
+        self.inflight.discard(future)
+        self.busy.discard(container_name)
+        self.batches.inc()
+        self.updates.inc(len(batch))
+
+        retrying = False
+        if not future.cancelled() and future.exception() is not None:
+            exc = future.exception()
+            logger.error("Could not apply %i cgroups rules to %s container %s" % (len(batch), self.name, container_name),
+                         exc_info=(type(exc), exc, exc.__traceback__))
+            self.errors.inc()
+            retrying = self.retry(container_name, batch)
+        else:
+            if not future.cancelled():
+                self.latency.observe(future.result())
+            for key, (update, waiter, attempts) in batch:
+                self.release(container_name, key, waiter, True)
+
+        # Retries wait a little, newer updates go with them
+        if container_name in self.pending and not retrying:
+            self.flush()
+
+    def retry(self, container_name, batch):
+        """
+        Queue the updates of a failed batch again, unless they were superseded.
+        Returns whether any are retried.
+        """
+        pending = self.pending.setdefault(container_name, collections.OrderedDict())
+        state = self.state.get(container_name, {})
+        retrying = False
+        for key, (update, waiter, attempts) in batch:
+            if key in pending:
+                self.release(container_name, key, waiter, False)
+            elif attempts + 1 >= self.max_attempts:
+                logger.error("Giving up on cgroups rule for %s container %s: %s = %s" % (self.name, container_name, update[0], update[1]))
+                # Don't skip it next time
+                if state.get(key) == update:
+                    del state[key]
+                self.release(container_name, key, waiter, False)
+            else:
+                pending[key] = (update, waiter, attempts + 1)
+                self.retries.inc()
+                retrying = True
+
+        if not pending:
+            del self.pending[container_name]
+        elif retrying:
+            asyncio.get_event_loop().call_later(self.retry_delay, self.flush)
+        return retrying
+
+    def release(self, container_name, key, waiter, applied):
+        waiters = self.waiters.get(container_name)
+        if waiters is not None and waiters.get(key) is waiter:
+            del waiters[key]
+        if not waiter.done():
+            waiter.set_result(applied)
 
     @classmethod
     def get(cls, name):
         if name in cls.registry:
             return cls.registry[name]
 
+    @classmethod
+    def get_executor(cls):
+        if cls.executor is None:
+            cls.executor = concurrent.futures.ThreadPoolExecutor(cls.max_workers)
+        return cls.executor
+
+    @classmethod
+    def forget_container(cls, container_name):
+        for manager in cls.registry.values():
+            manager.forget(container_name)
+
+    @classmethod
+    @asyncio.coroutine
+    def drain(cls):
+        """
+        Wait until all updates are applied
+        """
+        while cls.inflight or any(manager.pending for manager in cls.registry.values()):
+            for manager in cls.registry.values():
+                if manager.pending:
+                    manager.flush()
+            yield from asyncio.wait(list(cls.inflight))
+
+
 # Add the managers
 try:
     import lxc
 except ImportError:
     pass
 else:
+    lxc_containers = {} # container name -> lxc.Container
+
     @ControlGroupManager("lxc")
-    def lxc_cgroup_update(container_name, device, allow):
-        container = lxc.Container(container_name)
+    def lxc_cgroup_update(container_name, updates):
+        container = lxc_containers.get(container_name)
+        if container is None:
+            container = lxc_containers[container_name] = lxc.Container(container_name)
 
-        major, minor = device.get_major_minor()
-        if not major:
-            return
+        failed = [(file, rule) for file, rule in updates if not container.set_cgroup_item(file, rule)]
+        if failed:
+            # Have the batch retried
+            raise OSError("lxc could not set %s in container %s" % (", ".join("%s = %s" % item for item in failed), container_name))
 
-        type = 'b' if device.get_subsystem() == "block" else 'c'
-        perms = "rwm" if allow else "rm"
-        cgroup_subsystem = "devices.allow" if allow else "devices.deny"
 
-        logger.info("Adding cgroups rule to lxc container %s: %s = %s%i:%i %s" % (container_name, cgroup_subsystem, type, major, minor, perms))
-        container.set_cgroup_item(cgroup_subsystem, "%s %i:%i %s" % (type, major, minor, perms))
+@ControlGroupManager("cgroupfs")
+def cgroupfs_update(container_name, updates):
+    """
+    Write to the container's devices cgroup (v1) directly, see CGROUPFS_PATH
+    """
+    path = CGROUPFS_PATH % container_name
+    files = {}
+    try:
+        for file, rule in updates:
+            f = files.get(file)
+            if f is None:
+                f = files[file] = open(os.path.join(path, file), "wb", buffering=0)
+            # The kernel takes one rule per write
+            f.write(rule.encode())
+    finally:
+        for f in files.values():
+            f.close()
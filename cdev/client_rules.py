@@ -110,3 +110,21 @@ class RulesPreset(rules.RulesPreset):
         "TAG": UdevTagAssignment,
         "SYMLINK": UdevSymlinkAssignment,
     })
+
+
+def interesting_subsystems(rulesets):
+    """
+    Conservatively compute the set of SUBSYSTEM values any of rulesets assigns something for.
+
+    Returns None if any subsystem may be interesting.
+    """
+    subsystems = set()
+    for ruleset in rulesets:
+        interesting = rules.interesting_subsystems(ruleset, _has_effect)
+        if interesting is None:
+            return None
+        subsystems |= interesting
+    return subsystems
+
+def _has_effect(item):
+    return isinstance(item, rules._SimpleAssignment) and not isinstance(item, (rules.GotoAssignment, rules.DebugAssignment))
@@ -26,9 +26,13 @@ Can write udev database files.
 """
 
 import os
+import sys
+import hashlib
 import logging
 import weakref
 
+from . import murmurhash2
+
 logger = logging.getLogger(__name__)
 
 # udev runtime dir
@@ -38,6 +42,120 @@ RUNTIME_TAGS_PATH = RUNTIME_PATH + "/tags"
 SYS_PATH = "/sys"
 DEV_PATH = "/dev"
 
+# Property and environment keys repeat across every device and event.
+# Interning them lets all dicts share a single copy of each key string.
+intern = sys.intern
+
+
+def state_digest(environment, tags):
+    """
+    Digest of the udev db environment and tags a container was sent for a device.
+    Used to skip unchanged devices when booting a container again.
+    """
+    lines = sorted("E:%s=%s" % item for item in environment.items())
+    lines.extend(sorted("G:%s" % tag for tag in tags))
+    return hashlib.sha1("\n".join(lines).encode()).hexdigest()[:16]
+
+
+class DevpathTree:
+    """
+    Prefix tree over devpath components
+
+    Values are usually Device objects. Falsy values can be used to remember
+    paths that are known not to be devices.
+    """
+    __slots__ = ("root",)
+
+    class Node:
+        __slots__ = ("children", "value")
+
+        def __init__(self):
+            self.children = None
+            self.value = None
+
+    def __init__(self):
+        self.root = self.Node()
+
+    def _walk(self, devpath):
+        node = self.root
+        for component in devpath.split("/")[1:]:
+            if node.children is None:
+                return None
+            node = node.children.get(component)
+            if node is None:
+                return None
+        return node
+
+    def get(self, devpath, default=None):
+        node = self._walk(devpath)
+        if node is None or node.value is None:
+            return default
+        return node.value
+
+    def __setitem__(self, devpath, value):
+        """
+        Setting a device also drops the negative entries of its parent paths,
+        they may have become devices we didn't see, e.g. filtered ones.
+        """
+        node = self.root
+        for component in devpath.split("/")[1:]:
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(component)
+            if child is None:
+                child = node.children[intern(component)] = self.Node()
+            elif value and child.value is False:
+                child.value = None
+            node = child
+        node.value = value
+
+    def _remove(self, devpath, subtree):
+        # Remember the path so we can drop nodes that became empty
+        path = [self.root]
+        components = devpath.split("/")[1:]
+        for component in components:
+            children = path[-1].children
+            if children is None or component not in children:
+                return None
+            path.append(children[component])
+
+        node = path[-1]
+        node.value = None
+        if subtree:
+            node.children = None
+
+        for component, parent in zip(reversed(components), reversed(path[:-1])):
+            child = parent.children[component]
+            if child.value is not None or child.children:
+                break
+            del parent.children[component]
+
+        return node
+
+    def discard(self, devpath):
+        """
+        Remove the value at devpath, keep its children.
+        """
+        self._remove(devpath, False)
+
+    def prune(self, devpath):
+        """
+        Remove devpath and everything below it. Returns the removed values.
+        """
+        node = self._walk(devpath)
+        if node is None:
+            return []
+        values = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.value:
+                values.append(node.value)
+            if node.children:
+                stack.extend(node.children.values())
+        self._remove(devpath, True)
+        return values
+
 
 class Device:
     """
@@ -45,12 +163,20 @@ class Device:
     """
     __slots__ = ("syspath", "devpath", "sysname", "sysnum",
                  "devnum", "devnode", "devnode_mode", "devtype", "ifindex",
-                 "id_filename", "subsystem", "environment",
-                 "properties", "sysattrs", "devlinks", "tags", "_db_tags", "_db_unknown",
+                 "id_filename", "subsystem", "properties", "_derived",
+                 "_environment", "_sysattrs", "_devlinks", "_tags", "_db_tags", "_db_unknown", "_tag_bloom",
                  "is_uevent_loaded", "is_db_loaded", "is_initialized",
                  "__weakref__")
 
     registry = weakref.WeakValueDictionary()
+    tree = None # See enable_persistent_registry()
+
+    realpath_cache = {}
+    realpath_cache_size = 4096
+
+    # If set, registered devices for which registry_filter(device) is false are
+    # re-read from sysfs on lookup, e.g. because we might not see their uevents.
+    registry_filter = None
 
     def __init__(self):
         self.syspath = None
@@ -68,17 +194,66 @@ class Device:
         self.subsystem = None
 
         self.properties = {}
-        self.environment = {}
-        self.sysattrs = {}
-        self.devlinks = set()
-        self.tags = set()
-        self._db_tags = set()
-        self._db_unknown = []
+        self._derived = None # see from_props(share=True)
+
+        # The remaining containers are allocated on first use, see below.
+        self._environment = None
+        self._sysattrs = None
+        self._devlinks = None
+        self._tags = None
+        self._db_tags = None
+        self._db_unknown = None
+        self._tag_bloom = None
 
         self.is_uevent_loaded = False
         self.is_db_loaded = False
         self.is_initialized = False
 
+    # -------------------------------------------------------------------------
+    # [Lazily allocated containers]
+    # Most devices in the registry never get their db loaded or sysattrs read,
+    # so don't pay for empty dicts and sets up front.
+    @property
+    def environment(self):
+        if self._environment is None:
+            self._environment = {}
+        return self._environment
+
+    @environment.setter
+    def environment(self, value):
+        self._environment = value
+
+    @property
+    def sysattrs(self):
+        if self._sysattrs is None:
+            self._sysattrs = {}
+        return self._sysattrs
+
+    @sysattrs.setter
+    def sysattrs(self, value):
+        self._sysattrs = value
+
+    @property
+    def devlinks(self):
+        if self._devlinks is None:
+            self._devlinks = set()
+        return self._devlinks
+
+    @devlinks.setter
+    def devlinks(self, value):
+        self._devlinks = value
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = set()
+        return self._tags
+
+    @tags.setter
+    def tags(self, value):
+        self._tags = value
+        self._tag_bloom = None
+
     # -------------------------------------------------------------------------
     # [Handle special properties]
     # internal setter methods
@@ -97,10 +272,12 @@ class Device:
         self.sysnum = path[-i:]
 
     def set_subsystem(self, subsys):
+        subsys = intern(subsys)
         self.subsystem = subsys
         self.add_property("SUBSYSTEM", subsys)
 
     def set_devtype(self, devtype):
+        devtype = intern(devtype)
         self.devtype = devtype
         self.add_property("DEVTYPE", devtype)
 
@@ -120,6 +297,14 @@ class Device:
         NOTE: these are not persistent!!!
         use store_*_env() to modify the udev db.
         """
+        key = intern(key)
+        if self._derived is not None:
+            # Leave a shared properties map alone, see from_props()
+            if self.properties.get(key) != value:
+                self._derived[key] = value
+            else:
+                self._derived.pop(key, None)
+            return
         self.properties[key] = value
 
     # getters
@@ -166,6 +351,21 @@ class Device:
             self.read_db()
         return self.tags
 
+    def get_tag_bloom(self):
+        """
+        The 64-bit libudev tag bloom filter of this device
+
+        It's cached until the tags are replaced by read_db(), store_sync_buffer() or flush_db().
+        """
+        if not self.is_db_loaded:
+            self.read_db()
+        if self._tag_bloom is None:
+            bloom = 0
+            for tag in self._tags or ():
+                bloom |= murmurhash2.string_bloom64(tag)
+            self._tag_bloom = bloom
+        return self._tag_bloom
+
     def get_devlinks(self):
         if not self.is_db_loaded:
             self.read_db()
@@ -185,20 +385,29 @@ class Device:
         return self._getitem(key)
 
     def _getitem(self, key):
-        if key in self.properties:
+        if self._derived and key in self._derived:
+            return self._derived[key]
+        elif key in self.properties:
             return self.properties[key]
-        elif key in self.environment:
-            return self.environment[key]
+        elif self._environment is not None and key in self._environment:
+            return self._environment[key]
 
     def get_properties(self):
         if not self.is_uevent_loaded:
             self.read_uevent_file()
         if not self.is_db_loaded:
             self.read_db()
+        if self._derived:
+            props = dict(self.properties)
+            props.update(self._derived)
+            return props
         return self.properties
 
     def get_props_and_env(self):
-        return dict(self.get_properties(), **self.environment)
+        props = self.get_properties().copy()
+        if self._environment:
+            props.update(self._environment)
+        return props
 
     def get_environment(self):
         if not self.is_db_loaded:
@@ -208,7 +417,9 @@ class Device:
     def get_env(self, key, default=None):
         if not self.is_db_loaded:
             self.read_db()
-        return self.environment.get(key, default)
+        if self._environment is None:
+            return default
+        return self._environment.get(key, default)
 
     # -------------------------------------------------------------------------
     # [Manage relevant files]
@@ -312,10 +523,10 @@ class Device:
             self.is_initialized = True
 
             if clean:
-                self.devlinks = set()
-                self.environment = {}
-                self.tags = set()
-                self._db_unknown = []
+                self._devlinks = None
+                self._environment = None
+                self._tags = None
+                self._db_unknown = None
 
             for line in f:
                 line = line.rstrip("\n")
@@ -331,7 +542,7 @@ class Device:
                 elif line[0] == 'E':
                     # property
                     prop, value = line[2:].split("=", 1)
-                    self.environment[prop] = value
+                    self.environment[intern(prop)] = value
                 elif line[0] == 'G':
                     # tag
                     self.tags.add(line[2:])
@@ -342,10 +553,13 @@ class Device:
                     # initialization time
                 #    pass#self.set_usec_initialized(int(line[2:]))
                 else:
+                    if self._db_unknown is None:
+                        self._db_unknown = []
                     self._db_unknown.append(line)
 
         # We keep a copy of the current tags so we can update /run/udev/tags on flush_db()
-        self._db_tags = set(self.tags)
+        self._db_tags = frozenset(self._tags) if self._tags else None
+        self._tag_bloom = None
 
         #logger.info("Read udev db file for %s" % self.devpath)
 
@@ -398,18 +612,20 @@ class Device:
         props = properties.upper()
 
         sync = []
-        if "E" in props:
-            for item in self.environment.items():
+        if "E" in props and self._environment:
+            for item in self._environment.items():
                 sync.append("E:{}={}".format(*item).encode())
-        if "G" in props:
-            for tag in self.tags:
+        if "G" in props and self._tags:
+            for tag in self._tags:
                 sync.append("G:{}".format(tag).encode())
         return b'\n'.join(sync)
 
 
-    def store_sync_buffer(self, buffer, properties="EG", *, db_file=None):
+    def store_sync_buffer(self, buffer, properties="EG", *, db_file=None, flush=True):
         """
         Replace specified properties with those from the sync buffer
+
+        With flush=False, the caller has to flush_db() later.
         """
         self.read_db(db_file=db_file)
 
@@ -432,7 +648,7 @@ class Device:
                 except:
                     logger.warn("Could not parse ENV entry %s" % line)
                 else:
-                    self.environment[k] = v
+                    self.environment[intern(k)] = v
 
             elif line[0] in b'G':
                 self.tags.add(line[2:].decode())
@@ -440,7 +656,55 @@ class Device:
             else:
                 logger.warn("Unknown sync type: %s" % chr(line[0]))
 
-        self.flush_db(db_file=db_file)
+        if flush:
+            self.flush_db(db_file=db_file)
+
+    def get_sync_data(self, properties="EG", *, db_file=None):
+        """
+        Like make_sync_buffer(), but return the environment dict and tag list
+        """
+        self.read_db(db_file=db_file)
+        props = properties.upper()
+
+        environment = self._environment if "E" in props and self._environment else {}
+        tags = list(self._tags) if "G" in props and self._tags else []
+        return environment, tags
+
+    def store_sync_data(self, environment, tags, properties="EG", *, db_file=None, flush=True):
+        """
+        Like store_sync_buffer(), but from an environment dict and tag list
+        """
+        self.read_db(db_file=db_file)
+        props = properties.upper()
+
+        if "E" in props:
+            self.environment.clear()
+            for k, v in environment.items():
+                self.environment[intern(k)] = v
+        if "G" in props:
+            self.tags = set(tags)
+
+        if flush:
+            self.flush_db(db_file=db_file)
+
+    def patch_sync_data(self, environment, unset, tags, untag, *, db_file=None, flush=True):
+        """
+        Update the environment and tags in place: set and unset environment
+        keys, add and remove tags
+        """
+        self.read_db(db_file=db_file)
+
+        if environment or unset:
+            env = self.environment
+            for k, v in environment.items():
+                env[intern(k)] = v
+            for k in unset:
+                env.pop(k, None)
+        if tags or untag:
+            self.tags = (self.tags | set(tags)) - set(untag)
+
+        if flush:
+            self.flush_db(db_file=db_file)
 
     def _add_tags(self, tags):
         """
@@ -487,10 +751,15 @@ class Device:
 
         note that setting db_file implies update_tags=False
         """
+        # The tags may have been modified in-place
+        self._tag_bloom = None
+
         if update_tags and db_file is None:
-            self._add_tags(self.tags - self._db_tags)
-            self._del_tags(self._db_tags - self.tags)
-            self._db_tags = set(self.tags)
+            tags = self._tags or frozenset()
+            db_tags = self._db_tags or frozenset()
+            self._add_tags(tags - db_tags)
+            self._del_tags(db_tags - tags)
+            self._db_tags = frozenset(tags) if tags else None
 
         if db_file is None:
             id = self.get_id_filename()
@@ -499,13 +768,13 @@ class Device:
             db_file = os.path.join(RUNTIME_DATA_PATH, id)
 
         with open(db_file, "w") as fp:
-            for devlink in self.devlinks:
+            for devlink in self._devlinks or ():
                 fp.write("S:%s\n" % devlink)
-            for env_entry in self.environment.items():
+            for env_entry in (self._environment or {}).items():
                 fp.write("E:%s=%s\n" % env_entry)
-            for tag in self.tags:
+            for tag in self._tags or ():
                 fp.write("G:%s\n" % tag)
-            for line in self._db_unknown:
+            for line in self._db_unknown or ():
                 fp.write("%s\n" % line)
 
     # -------------------------------------------------------------------------
@@ -552,23 +821,33 @@ class Device:
 
         self = cls()
         self.set_syspath(path)
-        cls.registry[path] = self
+        self.register()
         return self
 
     @classmethod
     def from_syspath(cls, syspath):
-        return cls._from_real_syspath(syspath, os.path.realpath(syspath))
+        return cls._from_real_syspath(syspath, cls.realpath(syspath))
 
     @classmethod
     def from_syspath_or_registry(cls, syspath):
+        # Registered devices are keyed by their real path, so a hit means there's nothing to resolve
+        device = cls.registry.get(syspath)
+        if device is not None and cls._is_trusted(device):
+            return device
+
         # possibly a symlink
-        path = os.path.realpath(syspath)
+        path = cls.realpath(syspath)
 
-        if path in cls.registry:
-            return cls.registry[path]
+        device = cls.registry.get(path)
+        if device is not None and cls._is_trusted(device):
+            return device
         else:
             return cls._from_real_syspath(syspath, path)
 
+    @classmethod
+    def _is_trusted(cls, device):
+        return cls.registry_filter is None or cls.registry_filter(device)
+
     @classmethod
     def from_devpath(cls, devpath):
         return cls.from_syspath(SYS_PATH + devpath)
@@ -578,10 +857,21 @@ class Device:
         return cls.from_syspath_or_registry(SYS_PATH + devpath)
 
     @classmethod
-    def from_props(cls, props, *, from_uevent=False):
-        # Needs at least DEVPATH!
+    def from_props(cls, props, *, from_uevent=False, share=False):
+        """
+        Create a device from a uevent property dict. Needs at least DEVPATH!
+
+        With share=True, the device adopts props as its own properties dict
+        instead of copying it, and never modifies it. The caller must not put
+        ACTION into it. Properties the device derives itself, like KERNEL and
+        the normalized DEVNAME, are kept separately.
+        """
         self = cls()
-        self.properties = dict(props)
+        if share:
+            self.properties = props
+            self._derived = {}
+        else:
+            self.properties = dict(props)
         self.set_syspath(SYS_PATH + props["DEVPATH"])
         if "SUBSYSTEM" in props:
             self.set_subsystem(props["SUBSYSTEM"])
@@ -602,20 +892,40 @@ class Device:
         self.is_uevent_loaded = from_uevent
 
         # The device itself doesn't have an action!
-        if "ACTION" in props:
+        if not share and "ACTION" in self.properties:
             del self.properties["ACTION"]
 
-        cls.registry[self.syspath] = self
+        self.register()
         return self
 
     def get_parent(self):
         """
         Get this device's parent.
+
+        Our syspath is a real path, so all of its prefixes are, too. That means
+        we can skip realpath() and only need to touch sysfs for paths we don't know yet.
         """
+        tree = self.tree
         devpath = self.devpath
         while "/" in devpath[1:]: # don't return devices for things like /devices or /class
             devpath = devpath.rsplit("/", 1)[0]
-            device = self.from_devpath_or_registry(devpath)
+
+            if tree is not None:
+                device = tree.get(devpath)
+                if device is False: # known not to be a device
+                    continue
+            else:
+                device = self.registry.get(SYS_PATH + devpath)
+
+            if device is not None and not self._is_trusted(device):
+                device = None
+
+            if device is None:
+                syspath = SYS_PATH + devpath
+                device = self._from_real_syspath(syspath, syspath)
+                if device is None and tree is not None:
+                    tree[devpath] = False
+
             if device:
                 return device
 
@@ -627,17 +937,74 @@ class Device:
         Make the registry strong.
         This means the application needs to manually invalidate devices on changes (listen to UEVENTs)
         On the other hand, this makes the registry much more efficient.
+
+        Also builds a DevpathTree of the registry, which makes get_parent() a pure in-memory operation.
         """
         cls.registry = dict(cls.registry)
+        cls.tree = DevpathTree()
+        for device in cls.registry.values():
+            cls.tree[device.devpath] = device
+
+    def register(self):
+        self.registry[self.syspath] = self
+        if self.tree is not None:
+            self.tree[self.devpath] = self
+
+    @classmethod
+    def realpath(cls, syspath):
+        """
+        os.path.realpath() with a cache for paths that involve symlinks.
+        """
+        try:
+            return cls.realpath_cache[syspath]
+        except KeyError:
+            pass
+
+        path = os.path.realpath(syspath)
+
+        # Only remember actual symlink resolutions, a missing path might show up later.
+        if path != syspath:
+            if len(cls.realpath_cache) >= cls.realpath_cache_size:
+                cls.realpath_cache.clear()
+            cls.realpath_cache[syspath] = path
+
+        return path
 
     @classmethod
     def invalidate_syspath(cls, syspath):
         if syspath in cls.registry:
             del cls.registry[syspath]
+        if cls.tree is not None:
+            cls.tree.discard(syspath[len(SYS_PATH):])
 
     @classmethod
     def invalidate_devpath(cls, devpath):
         cls.invalidate_syspath(SYS_PATH + devpath)
 
+    @classmethod
+    def invalidate_devpath_tree(cls, devpath):
+        """
+        Forget everything at or below devpath.
+
+        Use on remove and move events: all of the children go away or move with the device,
+        and symlinks pointing there are no longer valid.
+        """
+        syspath = SYS_PATH + devpath
+        prefix = syspath + "/"
+
+        if cls.tree is not None:
+            for device in cls.tree.prune(devpath):
+                if cls.registry.get(device.syspath) is device:
+                    del cls.registry[device.syspath]
+        else:
+            for path in [path for path in cls.registry.keys() if path == syspath or path.startswith(prefix)]:
+                del cls.registry[path]
+
+        for link in [link for link, path in cls.realpath_cache.items() if path == syspath or path.startswith(prefix)]:
+            del cls.realpath_cache[link]
+
     def invalidate(self):
-        del self.registry[self.syspath]
+        if self.registry.get(self.syspath) is self:
+            del self.registry[self.syspath]
+        if self.tree is not None and self.tree.get(self.devpath) is self:
+            self.tree.discard(self.devpath)
@@ -23,7 +23,16 @@
 Rules that cdevd applies to decide whether it should forward an event.
 """
 
+import os
+import asyncio
+import logging
+import itertools
+import collections
+
 from . import rules
+from .device import SYS_PATH
+
+logger = logging.getLogger(__name__)
 
 
 class Context(rules.Context):
@@ -93,7 +102,7 @@ class CGroups(rules._Assignment):
 
     @classmethod
     def create_value(cls, value):
-        if value.lower() not in ("lxc",):
+        if value.lower() not in ("lxc", "cgroupfs"):
             raise SyntaxError("Unknown value for CGROUPS: %s" % value)
         return value.lower()
 
@@ -158,38 +167,303 @@ class ActionAssignment(rules._Assignment):
 
 
 # -----------------------------------------------------------------------------
-cdev_env = {}
+class CENVStore:
+    """
+    Holds the CENV{} values set by filter rules, keyed by device id filename.
+
+    The values are kept in an append-only log so they survive cdevd restarts.
+    Records are collected and written in one go once the event loop gets
+    around to it. The log is compacted on open and whenever it accumulates
+    too much garbage.
+
+    Entries are kept in least recently set order, a full store evicts a
+    chunk of the oldest ones.
+
+    Log records are NUL-separated fields, one per line:
+        S <id> <devpath> <key> <value>  -- set a value
+        R <id>                          -- remove all values of a device
+
+    If set, listener(record) is called with every record of a change made
+    here, and apply(record) replays changes made elsewhere; that's how cdevd
+    worker processes keep their stores in sync.
+    """
+    def __init__(self, max_entries=65536):
+        self.entries = collections.OrderedDict() # id -> {key: value}, least recently set first
+        self.devpaths = {}      # id -> devpath, to find vanished devices
+        self.ids = {}           # devpath -> id, caches get_id_filename()
+        self.max_entries = max_entries
+
+        self.log_path = None
+        self.log = None
+        self.log_records = 0
+        self.pending = []       # records not written yet
+        self.flush_scheduled = False
+        self.flush_records = 1024 # write right away once this many are pending
+
+        self.listener = None
+
+    def __bool__(self):
+        return bool(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Device ids
+    def id_of(self, device):
+        id = self.ids.get(device.devpath)
+        if id is None:
+            id = device.get_id_filename()
+            if id is not None:
+                self.ids[device.devpath] = id
+        return id
+
+    # Access
+    def get(self, device, key):
+        if not self.entries:
+            return None
+        id = self.id_of(device)
+        if id not in self.entries:
+            return None
+        return self.entries[id].get(key)
+
+    def set(self, device, key, value):
+        id = self.id_of(device)
+        if not id:
+            return
+
+        values = self.entries.get(id)
+        if values is None:
+            if len(self.entries) >= self.max_entries:
+                self.evict()
+            values = self.entries[id] = {}
+            self.devpaths[id] = device.devpath
+        elif values.get(key) == value:
+            return
+        else:
+            self.entries.move_to_end(id)
+
+        values[key] = value
+        self._log(b"S", id, device.devpath, key, value)
+
+    def remove(self, device):
+        id = self.ids.pop(device.devpath, None) or device.get_id_filename()
+        if id in self.entries:
+            self._remove(id)
+
+    def invalidate_devpath(self, devpath):
+        """
+        Forget cached ids at or below devpath (e.g. after a move)
+        """
+        prefix = devpath + "/"
+        for path in [path for path in self.ids if path == devpath or path.startswith(prefix)]:
+            del self.ids[path]
+
+    def _remove(self, id):
+        del self.entries[id]
+        devpath = self.devpaths.pop(id, None)
+        if devpath is not None and self.ids.get(devpath) == id:
+            del self.ids[devpath]
+        self._log(b"R", id)
+
+    def evict(self):
+        """
+        Make room for a chunk of new entries. Of the least recently set entries,
+        those of devices that don't exist anymore go first, then the oldest ones.
+        """
+        chunk = max(1, self.max_entries // 16)
+
+        oldest = list(itertools.islice(self.entries, 2 * chunk))
+        gone = [id for id in oldest if not os.path.exists(SYS_PATH + self.devpaths[id])][:chunk]
+        for id in gone:
+            self._remove(id)
+
+        if len(gone) < chunk:
+            logger.warn("CENV store full, dropping values for %i devices" % (chunk - len(gone)))
+            for id in list(itertools.islice(self.entries, chunk - len(gone))):
+                self._remove(id)
+
+    def apply(self, record):
+        """
+        Apply a log record of a change made elsewhere, without notifying the listener
+        """
+        fields = record.rstrip(b"\n").decode().split("\0")
+        if fields[0] == "S" and len(fields) == 5:
+            _, id, devpath, key, value = fields
+            if id not in self.entries:
+                if len(self.entries) >= self.max_entries:
+                    self.evict()
+                self.entries[id] = {}
+                self.devpaths[id] = devpath
+                self.ids[devpath] = id
+            else:
+                self.entries.move_to_end(id)
+            self.entries[id][key] = value
+        elif fields[0] == "R" and len(fields) == 2:
+            id = fields[1]
+            if id not in self.entries:
+                return
+            del self.entries[id]
+            devpath = self.devpaths.pop(id, None)
+            if devpath is not None and self.ids.get(devpath) == id:
+                del self.ids[devpath]
+        else:
+            logger.warn("Ignoring broken CENV record: %r" % record)
+            return
+        self._write(record)
+
+    # Persistence
+    def open(self, path):
+        """
+        Load state from the log at path and keep appending to it.
+        """
+        self.log_path = path
+
+        if os.path.exists(path):
+            self.load(path)
+
+        os.makedirs(os.path.dirname(path), 0o755, True)
+        self.compact()
+
+        logger.info("Restored CENV values for %i devices from %s" % (len(self.entries), path))
+
+    def load(self, path):
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break # torn write at the end
+                fields = line[:-1].decode().split("\0")
+                if fields[0] == "S" and len(fields) == 5:
+                    _, id, devpath, key, value = fields
+                    self.entries.setdefault(id, {})[key] = value
+                    self.entries.move_to_end(id)
+                    self.devpaths[id] = devpath
+                elif fields[0] == "R" and len(fields) == 2:
+                    self.entries.pop(fields[1], None)
+                    self.devpaths.pop(fields[1], None)
+                else:
+                    logger.warn("Ignoring broken CENV log record: %r" % line)
+
+        self.ids = {devpath: id for id, devpath in self.devpaths.items()}
+
+    def compact(self):
+        """
+        Rewrite the log to contain only the current state
+        """
+        if self.log_path is None:
+            return
+
+        if self.log is not None:
+            self.log.close()
+        # The new log has everything
+        del self.pending[:]
+
+        tmp_path = self.log_path + ".new"
+        records = 0
+        with open(tmp_path, "wb") as f:
+            for id, values in self.entries.items():
+                for key, value in values.items():
+                    f.write(self._record(b"S", id, self.devpaths[id], key, value))
+                    records += 1
+        os.rename(tmp_path, self.log_path)
+
+        self.log = open(self.log_path, "ab", buffering=0)
+        self.log_records = records
+
+    def close(self):
+        if self.log is not None:
+            self.compact()
+            self.log.close()
+            self.log = None
+
+    def detach(self):
+        """
+        Stop writing the log without touching it, e.g. in a forked process
+        """
+        if self.log is not None:
+            self.log.close()
+        self.log = None
+        self.log_path = None
+        del self.pending[:]
+
+    @staticmethod
+    def _record(type, *fields):
+        return b"\0".join((type,) + tuple(field.encode() for field in fields)) + b"\n"
+
+    def _log(self, type, *fields):
+        record = self._record(type, *fields)
+        self._write(record)
+        if self.listener is not None:
+            self.listener(record)
+
+    def _write(self, record):
+        if self.log is None:
+            return
+        self.pending.append(record)
+        self.log_records += 1
+
+        if len(self.pending) >= self.flush_records:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_event_loop().call_soon(self.flush)
+
+    def flush(self):
+        """
+        Write the pending records to the log
+        """
+        self.flush_scheduled = False
+        if self.log is None or not self.pending:
+            return
+
+        # Compact once the log is mostly garbage
+        if self.log_records > 1024 and self.log_records > 4 * sum(map(len, self.entries.values())):
+            self.compact()
+        else:
+            self.log.write(b"".join(self.pending))
+            del self.pending[:]
+
+
+cenv = CENVStore()
+
 
 class CENV(rules._ParameterizedSimpleAssignment):
     __slots__ = ()
 
     def assign(self, context):
-        id = context.device.get_id_filename()
-        if not id:
-            return
-        if id not in cdev_env:
-            cdev_env[id] = {}
-        cdev_env[id][self.parameter] = self.value
+        cenv.set(context.device, self.parameter, self.value)
 
 class CENVCondition(rules._GeneralizedCondition):
     __slots__ = ()
 
     def lvalue(self, device):
-        id = device.get_id_filename()
-        if not id:
-            return
-        if id not in cdev_env:
-            return
-        if self.lvalue_source not in cdev_env[id]:
-            return
-        return cdev_env[id][self.lvalue_source]
+        return cenv.get(device, self.lvalue_source)
 
 class CENVSCondition(rules._HierarchyCondition, CENVCondition):
     __slots__ = ()
 
+    def __call__(self, context):
+        # Without any values, every device in the hierarchy yields None
+        if not cenv:
+            return self.operation(None, self.rvalue)
+        return super().__call__(context)
+
 def cenv_remove(device):
-    if device.get_id_filename() in cdev_env:
-        del cdev_env[device.get_id_filename()]
+    cenv.remove(device)
+
+
+# -----------------------------------------------------------------------------
+# Static analysis
+def interesting_subsystems(ruleset):
+    """
+    Conservatively compute the set of SUBSYSTEM values for which ruleset can
+    allow an event or otherwise have side effects (CENV).
+
+    Returns None if any subsystem may be interesting.
+    """
+    return rules.interesting_subsystems(ruleset, _has_effect)
+
+def _has_effect(item):
+    return (isinstance(item, Target) and item.value) or isinstance(item, CENV)
 
 
 # -----------------------------------------------------------------------------
@@ -63,7 +63,8 @@ STATE_CHOICE_GROUP      = 0x08
 
 class FnmatchExprParser:
     def __init__(self):
-        self.regexp = ['^']
+        # Group the whole expression, so top level alternatives stay anchored
+        self.regexp = ['^(?:']
         self.state_stack = [STATE_NORMAL]
 
     # Access state
@@ -193,7 +194,7 @@ class FnmatchExprParser:
     def finish(self) -> str:
         if len(self.state_stack) != 1:
             raise ValueError("Unbalanced Expression.")
-        self.regexp.append('$')
+        self.regexp.append(')$')
         return ''.join(self.regexp)
 
 
@@ -210,3 +211,16 @@ def compile(expr: str) -> "re.Pattern":
 def match(string: str, expr: str) -> "re.Match":
     return re.match(translate(expr), string)
 
+
+def literals(expr: str) -> "set":
+    """
+    Get the set of strings matched by expr, if it only consists of literal alternatives (a|b|c).
+    Returns None if expr contains any other special characters.
+
+    This relies on translate() anchoring every top level alternative.
+    """
+    alternatives = expr.split('|')
+    for alternative in alternatives:
+        if any(c in "\\[]{}^?*+" for c in alternative):
+            return None
+    return set(alternatives)
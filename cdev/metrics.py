@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Simple in-process metrics
+
+Metrics are created by name and live in a module-level registry:
+
+    received = cdev.metrics.counter("netlink.datagrams")
+    received.inc()
+
+snapshot() returns all current values as a JSON-compatible dict.
+"""
+
+import time
+
+registry = {}
+
+
+class Counter:
+    """
+    A monotonically increasing count
+    """
+    __slots__ = ("name", "value")
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.value
+
+
+class Summary:
+    """
+    Count, sum and maximum of observed values (sizes, latencies)
+    """
+    __slots__ = ("name", "count", "total", "max")
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def time(self):
+        """
+        Context manager observing the elapsed time in seconds
+        """
+        return _Timer(self)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "avg": self.total / self.count if self.count else 0,
+            "max": self.max,
+        }
+
+
+class Gauge:
+    """
+    A value computed on demand
+    """
+    __slots__ = ("name", "func")
+
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+
+    def snapshot(self):
+        return self.func()
+
+
+class _Timer:
+    __slots__ = ("summary", "start")
+
+    def __init__(self, summary):
+        self.summary = summary
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.summary.observe(time.monotonic() - self.start)
+
+
+def _get(cls, name, *args):
+    if name not in registry:
+        registry[name] = cls(name, *args)
+    return registry[name]
+
+def counter(name):
+    return _get(Counter, name)
+
+def summary(name):
+    return _get(Summary, name)
+
+def gauge(name, func):
+    """
+    Register func as gauge, replacing any previous one of the same name
+    """
+    registry[name] = Gauge(name, func)
+    return registry[name]
+
+def remove(name):
+    registry.pop(name, None)
+
+def snapshot():
+    return {name: metric.snapshot() for name, metric in sorted(registry.items())}
+
+def format():
+    """
+    Format a snapshot for logging
+    """
+    return "\n".join("%s: %s" % item for item in snapshot().items())
@@ -30,6 +30,11 @@ Conclusion:
 
 import array
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 if array.array('L').itemsize == 4:
     uint32_t = 'L'
 elif array.array('I').itemsize == 4:
@@ -110,3 +115,87 @@ def util_string_bloom64(input):
     h = MurmurHash2(input)
 
     return (1 << (h & 63)) | (1 << ((h >> 6) & 63)) | (1 << ((h >> 12) & 63)) | (1 << ((h >> 18) & 63))
+
+
+# Cached hashes
+# There are only a few dozen distinct subsystems, devtypes and tags on any
+# system, so hashing them over and over again is a waste.
+string_hash_cache = {}
+string_hash_cache_size = 4096
+
+def string_hash32(string):
+    """
+    Cached MurmurHash2 of a str, as in libudev-util.c
+    """
+    h = string_hash_cache.get(string)
+    if h is None:
+        if len(string_hash_cache) >= string_hash_cache_size:
+            string_hash_cache.clear()
+        h = string_hash_cache[string] = MurmurHash2(string.encode())
+    return h
+
+def string_bloom64(string):
+    """
+    Cached util_string_bloom64 of a str
+    """
+    h = string_hash32(string)
+
+    return (1 << (h & 63)) | (1 << ((h >> 6) & 63)) | (1 << ((h >> 12) & 63)) | (1 << ((h >> 18) & 63))
+
+
+# Batch API
+def MurmurHash2_many(inputs, seed=0):
+    """
+    Hash a sequence of bytestrings at once, returns a list of hashes.
+
+    Uses numpy to hash all inputs in parallel, one 4-byte word at a time.
+    That pays off for many short strings, like when generating the events
+    for every device at boot.
+    Falls back to MurmurHash2() if numpy is not available.
+    """
+    if numpy is None or len(inputs) < 16:
+        return [MurmurHash2(input, seed) for input in inputs]
+
+    uint32 = numpy.uint32
+    m = uint32(0x5bd1e995)
+
+    lengths = numpy.fromiter(map(len, inputs), numpy.int64, len(inputs))
+    words = lengths // 4
+    rest = lengths % 4
+
+    # Pad all inputs to the same number of words, plus one for the tail bytes
+    nwords = int(words.max()) + 1
+    width = nwords * 4
+    data = numpy.frombuffer(b"".join(input.ljust(width, b"\0") for input in inputs), numpy.uint8).reshape(len(inputs), width)
+
+    h = (lengths ^ seed).astype(uint32)
+
+    # Mix 4 bytes at a time into the hash
+    blocks = data.view(uint32)
+    for i in range(nwords - 1):
+        k = blocks[:, i] * m
+        k = (k ^ (k >> uint32(24))) * m
+        numpy.copyto(h, (h * m) ^ k, where=words > i)
+
+    # Handle the last few bytes of each input
+    rows = numpy.arange(len(inputs))
+    tail = data[rows, words * 4].astype(uint32), data[rows, words * 4 + 1].astype(uint32), data[rows, words * 4 + 2].astype(uint32)
+    h ^= numpy.where(rest > 2, tail[2] << uint32(16), uint32(0)).astype(uint32)
+    h ^= numpy.where(rest > 1, tail[1] << uint32(8), uint32(0)).astype(uint32)
+    numpy.copyto(h, (h ^ tail[0]) * m, where=rest > 0)
+
+    # Final mix
+    h = (h ^ (h >> uint32(13))) * m
+    h ^= h >> uint32(15)
+    return h.tolist()
+
+def string_hash32_many(strings):
+    """
+    Fill the string_hash32() cache for many strings at once
+    """
+    missing = list({string for string in strings if string not in string_hash_cache})
+    if missing:
+        if len(string_hash_cache) + len(missing) > string_hash_cache_size:
+            string_hash_cache.clear()
+        string_hash_cache.update(zip(missing, MurmurHash2_many([string.encode() for string in missing])))
+    return [string_hash32(string) for string in strings]
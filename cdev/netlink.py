@@ -24,7 +24,9 @@ Work with the udev monitor netlink messages
 
 import os
 import collections
+import collections.abc
 import logging
+from . import bpf
 from . import device
 from . import murmurhash2
 from . import struct
@@ -39,18 +41,229 @@ UDEV_NETLINK_UDEV = 2
 UDEV_NETLINK_CDEV = 4 #only for testing.
 
 
-def open_netlink(protocol, mcast_groups):
+def open_netlink(protocol, mcast_groups, rcvbuf=None):
     """
     Open an AF_NETLINK socket on \c protocol and listen to \c mcast_groups
+
+    \c rcvbuf sets the receive buffer size. Event storms overflow the default buffer easily.
     """
     sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, protocol)
+    if rcvbuf:
+        set_rcvbuf(sock, rcvbuf)
     sock.bind((0, mcast_groups)) # The kernel assigns the pid.
     return sock
 
 
+def set_rcvbuf(sock, size):
+    """
+    Set the socket receive buffer size, ignoring rmem_max if we're privileged
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUFFORCE, size)
+    except PermissionError:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+
+    # The kernel doubles the value for bookkeeping overhead
+    actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2
+    if actual < size:
+        logger.warn("Netlink receive buffer limited to %i bytes (wanted %i), raise net.core.rmem_max" % (actual, size))
+    return actual
+
+
 # -----------------------------------------------------------------------------
 # libudev NETLINK wire protocol
 
+_DELETED = object()
+
+class PropertyBuffer(collections.abc.MutableMapping):
+    """
+    A property mapping backed by a KEY=value\\0KEY=value... buffer.
+
+    Values are only looked up and decoded when accessed. Decoded values, writes and
+    deletions are kept in a small overlay dict. As long as nothing was changed,
+    raw() returns the original bytes so the properties don't need to be re-encoded.
+
+    Keys can be hidden with hide(), which removes them from the mapping without
+    counting as a modification. UdevNetlinkMessage uses it for ACTION.
+
+    Once all properties are needed (iteration, len(), items()), the parsed
+    dict is kept until the next write, deletion or hide().
+    """
+    __slots__ = ("buffer", "start", "end", "overlay", "hidden", "modified", "view")
+
+    def __init__(self, buffer, start=0, end=None):
+        self.buffer = buffer
+        self.start = start
+        self.end = len(buffer) if end is None else end
+        self.overlay = None
+        self.hidden = None
+        self.modified = False
+        self.view = None
+
+    def _lookup(self, key):
+        """
+        Find key in the buffer, returns the decoded value or None
+        """
+        buffer = self.buffer
+        needle = key.encode() + b"="
+
+        if buffer.startswith(needle, self.start):
+            value_start = self.start + len(needle)
+        else:
+            pos = buffer.find(b"\0" + needle, self.start, self.end)
+            if pos < 0:
+                return None
+            value_start = pos + 1 + len(needle)
+
+        value_end = buffer.find(b"\0", value_start, self.end)
+        if value_end < 0:
+            value_end = self.end
+        return buffer[value_start:value_end].decode()
+
+    def _buffer_items(self):
+        if self.start >= self.end:
+            return
+        for prop in self.buffer[self.start:self.end].split(b"\0"):
+            if prop:
+                key, value = prop.decode().split("=", 1)
+                yield device.intern(key), value
+
+    def __getitem__(self, key):
+        if self.view is not None:
+            return self.view[key]
+
+        overlay = self.overlay
+        if overlay is not None and key in overlay:
+            value = overlay[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+
+        if self.hidden is not None and key in self.hidden[::2]:
+            raise KeyError(key)
+
+        value = self._lookup(key)
+        if value is None:
+            raise KeyError(key)
+
+        # Cache the decoded value
+        if overlay is None:
+            self.overlay = overlay = {}
+        overlay[device.intern(key)] = value
+        return value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, key, value):
+        overlay = self.overlay
+        if overlay is None:
+            self.overlay = overlay = {}
+        elif overlay.get(key, _DELETED) == value:
+            return
+
+        if not self.modified and (self.hidden is not None and key in self.hidden[::2] or self._lookup(key) != value):
+            self.modified = True
+
+        overlay[device.intern(key)] = value
+        self.view = None
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.view = None
+        if self.overlay is None:
+            self.overlay = {}
+        self.overlay[device.intern(key)] = _DELETED
+        self.modified = True
+
+    def hide(self, key):
+        """
+        Remove key and return its value (or None), without marking the mapping modified
+        """
+        try:
+            value = self[key]
+        except KeyError:
+            return None
+        # A flat (key, value, ...) tuple, there's usually just the one
+        self.hidden = (self.hidden or ()) + (key, value)
+        self.view = None
+        if self.overlay is None:
+            self.overlay = {}
+        self.overlay[device.intern(key)] = _DELETED
+        return value
+
+    def _get_view(self):
+        if self.view is None:
+            self.view = self._parse()
+        return self.view
+
+    def materialize(self):
+        """
+        Get a real dict of all properties
+        """
+        return dict(self._get_view())
+
+    copy = materialize
+
+    def _parse(self):
+        props = {}
+        overlay = self.overlay
+        hidden = self.hidden[::2] if self.hidden is not None else ()
+        for key, value in self._buffer_items():
+            if key in hidden:
+                continue
+            if overlay is not None and key in overlay:
+                value = overlay[key]
+                if value is _DELETED:
+                    continue
+            props[key] = value
+        if overlay is not None:
+            for key, value in overlay.items():
+                if value is not _DELETED and key not in props:
+                    props[key] = value
+        return props
+
+    def keys(self):
+        return self._get_view().keys()
+
+    def values(self):
+        return self._get_view().values()
+
+    def items(self):
+        return self._get_view().items()
+
+    def __iter__(self):
+        return iter(self._get_view())
+
+    def __len__(self):
+        return len(self._get_view())
+
+    def raw(self):
+        """
+        The original buffer contents, including hidden keys, or None if modified.
+        """
+        if self.modified:
+            return None
+        return self.buffer[self.start:self.end]
+
+
+def parse_props(props_list):
+    """
+    Build a property dict from a list of KEY=value bytestrings.
+
+    Keys are interned, see cdev.device.intern
+    """
+    props = {}
+    for prop in props_list:
+        key, value = prop.decode().split("=", 1)
+        props[device.intern(key)] = value
+    return props
+
 # libudev NETLINK header info
 udev_netlink_header_prefix = b"libudev\0"
 udev_netlink_header_magic = 0xfeedcafe
@@ -70,6 +283,43 @@ class UdevNetlinkHeader(struct.MixStruct):
         return cls((udev_netlink_header_prefix, udev_netlink_header_magic, cls.size, cls.size, 0, 0, 0, 0, 0))
 
 
+def udev_monitor_filter(subsystems):
+    """
+    Build a BPF program that only passes libudev messages matching subsystems, like
+    udev_monitor_filter_update() in libudev.
+
+    subsystems is an iterable of SUBSYSTEM strings or (SUBSYSTEM, DEVTYPE) tuples.
+    Kernel messages are always passed, they don't carry the hashes.
+    """
+    magic_off = UdevNetlinkHeader.offsetof("magic")
+    subsystem_off = UdevNetlinkHeader.offsetof("filter_subsystem_hash")
+    devtype_off = UdevNetlinkHeader.offsetof("filter_devtype_hash")
+
+    prog = bpf.Program()
+
+    # pass everything that isn't a libudev message
+    prog.stmt(bpf.BPF_LD|bpf.BPF_W|bpf.BPF_ABS, magic_off)
+    prog.jump(bpf.BPF_JMP|bpf.BPF_JEQ|bpf.BPF_K, udev_netlink_header_magic, 1, 0)
+    prog.stmt(bpf.BPF_RET|bpf.BPF_K, bpf.PASS)
+
+    for item in sorted(subsystems, key=lambda x: x if isinstance(x, tuple) else (x,)):
+        subsystem, devtype = item if isinstance(item, tuple) else (item, None)
+
+        prog.stmt(bpf.BPF_LD|bpf.BPF_W|bpf.BPF_ABS, subsystem_off)
+        if devtype is None:
+            prog.jump(bpf.BPF_JMP|bpf.BPF_JEQ|bpf.BPF_K, murmurhash2.string_hash32(subsystem), 0, 1)
+        else:
+            prog.jump(bpf.BPF_JMP|bpf.BPF_JEQ|bpf.BPF_K, murmurhash2.string_hash32(subsystem), 0, 3)
+            prog.stmt(bpf.BPF_LD|bpf.BPF_W|bpf.BPF_ABS, devtype_off)
+            prog.jump(bpf.BPF_JMP|bpf.BPF_JEQ|bpf.BPF_K, murmurhash2.string_hash32(devtype), 0, 1)
+        prog.stmt(bpf.BPF_RET|bpf.BPF_K, bpf.PASS)
+
+    # nothing matched
+    prog.stmt(bpf.BPF_RET|bpf.BPF_K, bpf.DROP)
+
+    return prog
+
+
 class UdevNetlinkMessage:
     """
     A libudev message.
@@ -78,6 +328,7 @@ class UdevNetlinkMessage:
              It's only used for packing to and unpacking from bytestrings.
 
     ACTION is stored separately so we can share the properties dict with the device object.
+    It is removed from props when passed in.
     """
     __slots__ = ("header", "properties", "action", "original_buffer")
 
@@ -92,12 +343,17 @@ class UdevNetlinkMessage:
         else:
             self.properties = {}
 
+        if isinstance(self.properties, PropertyBuffer):
+            props_action = self.properties.hide("ACTION")
+        elif "ACTION" in self.properties:
+            props_action = self.properties.pop("ACTION")
+        else:
+            props_action = None
+
         if action is not None:
             self.action = action
-        elif "ACTION" in props:
-            self.action = props["ACTION"]
         else:
-            self.action = None
+            self.action = props_action
 
         self.original_buffer = None
 
@@ -112,7 +368,10 @@ class UdevNetlinkMessage:
         return self.properties[key]
 
     def make_device(self):
-        return device.Device.from_props(self.properties, from_uevent=True)
+        """
+        Create the device object, sharing our properties dict with it.
+        """
+        return device.Device.from_props(self.properties, from_uevent=True, share=True)
 
     def get_action(self):
         return self.action
@@ -133,11 +392,24 @@ class UdevNetlinkMessage:
 
     # Pack it into a bytestring
     def pack(self):
-        # TODO: don't run a check on everything. think of a better way.
-        props_buffer = b"ACTION=" + self.action.encode() + b'\0'
-        props_buffer += b"".join(("%s=%s\0" % i).encode() for i in self.properties.items() if i[0] != "ACTION")
-        self.header.properties_len = len(props_buffer)
-        return self.header.pack() + props_buffer
+        props = self.properties
+        props_buffer = None
+        if isinstance(props, PropertyBuffer) and props.hidden == ("ACTION", self.action):
+            # Unmodified properties from the wire, reuse them as-is.
+            raw = props.raw()
+            if raw is not None:
+                props_buffer = raw + b'\0'
+
+        if props_buffer is None:
+            props_buffer = "".join(["ACTION=%s\0" % self.action] + ["%s=%s\0" % i for i in props.items()]).encode()
+
+        header = self.header
+        header.properties_len = len(props_buffer)
+
+        buffer = bytearray(header.size + len(props_buffer))
+        header.pack_into(buffer, 0)
+        buffer[header.size:] = props_buffer
+        return bytes(buffer)
 
     # Create messages
     @classmethod
@@ -156,7 +428,7 @@ class UdevNetlinkMessage:
     @classmethod
     def from_props(cls, props, action=None):
         self = cls(props=props, action=action)
-        self.fill_hashes_from_props(props)
+        self.fill_hashes_from_props()
         return self
 
     @classmethod
@@ -168,42 +440,122 @@ class UdevNetlinkMessage:
             logger.error("libudev netlink message wih broken magic: %x" % header.magic)
             return None
 
-        props_buffer = buffer[offset+header.properties_off:offset+header.properties_off+header.properties_len-1] # we don't need the trailing \0, hence -1
-        props = dict(prop_x.decode().split('=', 1) for prop_x in props_buffer.split(b'\0'))
+        if not isinstance(buffer, bytes):
+            buffer = bytes(buffer)
+
+        # Properties are decoded lazily, straight from the buffer
+        props_start = offset + header.properties_off
+        props_end = props_start + header.properties_len - 1 # we don't need the trailing \0, hence -1
+        props = PropertyBuffer(buffer, props_start, props_end)
 
         self = cls(header=header, props=props)
-        self.original_buffer = buffer[offset:offset+header.header_size+header.properties_len]
+
+        message_end = offset + header.header_size + header.properties_len
+        if offset == 0 and message_end == len(buffer):
+            self.original_buffer = buffer
+        else:
+            self.original_buffer = buffer[offset:message_end]
 
         return self
 
     @classmethod
     def from_kernel_message(cls, kern_message):
-        props = dict((prop.decode().split("=", 1) for prop in kern_message.split(b'\0')[1:-1]))
-        self = cls(props=props)
-        self.fill_hashes_from_props(props)
+        if not isinstance(kern_message, bytes):
+            kern_message = bytes(kern_message)
+        # skip the action@devpath header and the trailing \0
+        start = kern_message.find(b'\0') + 1
+        end = len(kern_message) - 1 if kern_message.endswith(b'\0') else len(kern_message)
+        self = cls(props=PropertyBuffer(kern_message, start, end))
+        self.fill_hashes_from_props()
         return self
 
     # Fill the *_hash and *_bloom fields in the header
     def fill_hashes_from_device(self, device):
         subsystem = device.get_subsystem()
         if subsystem is not None:
-            self.header.filter_subsystem_hash = murmurhash2.MurmurHash2(subsystem.encode())
+            self.header.filter_subsystem_hash = murmurhash2.string_hash32(subsystem)
         devtype = device.get_devtype()
         if devtype is not None:
-            self.header.filter_devtype_hash = murmurhash2.MurmurHash2(devtype.encode())
+            self.header.filter_devtype_hash = murmurhash2.string_hash32(devtype)
 
     def fill_bloom_from_device(self, device):
-        tag_bloom_bits = 0
-        for tag in device.get_tags():
-            tag_bloom_bits |= murmurhash2.util_string_bloom64(tag.encode())
+        tag_bloom_bits = device.get_tag_bloom()
         self.header.filter_tag_bloom_hi = tag_bloom_bits >> 32
         self.header.filter_tag_bloom_lo = tag_bloom_bits & 0xFFFFFFFF
 
     def fill_hashes_from_props(self):
         if "SUBSYSTEM" in self.properties:
-            self.header.filter_subsystem_hash = murmurhash2.MurmurHash2(self.properties["SUBSYSTEM"].encode())
+            self.header.filter_subsystem_hash = murmurhash2.string_hash32(self.properties["SUBSYSTEM"])
         if "DEVTYPE" in self.properties:
-            self.header.filter_devtype_hash = murmurhash2.MurmurHash2(self.properties["DEVTYPE"].encode())
+            self.header.filter_devtype_hash = murmurhash2.string_hash32(self.properties["DEVTYPE"])
+
+
+def prime_hash_cache(devices):
+    """
+    Hash the subsystems and devtypes of many devices in one batch,
+    e.g. before generating events for all devices at boot.
+    """
+    strings = set()
+    for dev in devices:
+        strings.add(dev.get_subsystem())
+        strings.add(dev.get_devtype())
+    strings.discard(None)
+    murmurhash2.string_hash32_many(list(strings))
+
+
+class EncodedEvent:
+    """
+    Caches the wire buffers of one event, so every distinct variant is only
+    packed once, no matter how many clients it's sent to.
+
+    Variants are keyed by (include_env, action).
+    """
+    __slots__ = ("device", "action", "event", "buffers", "related")
+
+    def __init__(self, device, action, event=None):
+        self.device = device
+        self.action = action
+        self.event = event
+        self.buffers = {}
+        self.related = None
+
+    def get(self, include_env=True, action=None):
+        if action is None:
+            action = self.action
+
+        key = include_env, action
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = self._pack(include_env, action)
+        return buffer
+
+    def _pack(self, include_env, action):
+        event = self.event
+
+        if event is None:
+            return UdevNetlinkMessage.from_device_and_action(self.device, action, include_env=include_env).pack()
+
+        if include_env:
+            if action == event.action and event.original_buffer is not None:
+                return event.original_buffer
+            if action != event.action:
+                event = event.clone(action=action)
+        else:
+            # we need to remove the environment info
+            event = event.clone(props=self.device.get_properties(), action=action)
+
+        return event.pack()
+
+    def get_related(self, device):
+        """
+        Get the EncodedEvent for another device triggered by this one (see ACTION+=)
+        """
+        if self.related is None:
+            self.related = {}
+        related = self.related.get(device.devpath)
+        if related is None or related.device is not device:
+            related = self.related[device.devpath] = type(self)(device, self.action)
+        return related
 
 
 # Handle the messages (legacy)
@@ -211,13 +563,14 @@ def udev_netlink_message_get_props(buffer, offset=0):
     """
     Parse a libudev uevent message
     """
-    return UdevNetlinkMessage.parse(buffer, offset).properties
+    message = UdevNetlinkMessage.parse(buffer, offset)
+    return dict(message.properties, ACTION=message.action)
 
 def uevent_netlink_message_get_props(buffer):
     """
     Kernel uevent messages are simple.
     """
-    return dict((prop.decode().split("=", 1) for prop in buffer.split(b'\0')[1:-1])) # again, we don't want the trailing \0, we also don't need the header.
+    return parse_props(buffer.split(b'\0')[1:-1]) # again, we don't want the trailing \0, we also don't need the header.
 
 def udev_netlink_message_generic_get_props(buffer):
     """
@@ -30,6 +30,8 @@ def _recv(sock, n):
     data = list()
     while n > 0:
         d = sock.recv(n)
+        if not d:
+            raise EOFError("Connection closed")
         n -= len(d)
         data.append(d)
     return b"".join(data)
@@ -39,6 +41,7 @@ D_DATA = 0x0
 D_STRU = 0x1
 D_JSON = 0x2
 D_PIKL = 0x3
+D_SCHM = 0x4 # encoded with the connection's cdev.schema.Codec
 
 def serialize_data(type, data, fmt=None):
     if type == D_DATA:
@@ -49,20 +52,27 @@ def serialize_data(type, data, fmt=None):
         return json.dumps(data).encode()
     elif type == D_PIKL:
         return pickle.dumps(data)
+    elif type == D_SCHM:
+        return data
     else:
         raise TypeError("Unknown serialize type: %x" % type)
 
 def deserialize_data(type, data):
+    """
+    data may be any bytes-like object, e.g. a memoryview into a receive buffer
+    """
     if type == D_DATA:
-        return data, None
+        return bytes(data), None
     elif type == D_STRU:
         fmt_size = struct.unpack_from("!H", data, 0)[0]
         fmt = str(data[2:2+fmt_size], "ascii")
         return struct.unpack_from(fmt, data, 2 + fmt_size), fmt
     elif type == D_JSON:
-        return json.loads(data.decode()), None
+        return json.loads(str(data, "utf-8")), None
     elif type == D_PIKL:
         return pickle.loads(data), None
+    elif type == D_SCHM:
+        return bytes(data), None
     else:
         raise TypeError("Cannot deserialize type %x" % type)
 
@@ -70,6 +80,38 @@ def unpack_header(data, offset=0):
     return struct.unpack_from("!11pBQ", data, offset)
 
 
+# Optional protocol features, the server lists them in a D_JSON HELLO and
+# the client picks the ones it wants in its D_JSON hello.
+F_BATCH = "batch" # BATCH frames, see pack_batch()
+F_SCHEMA = "schema" # D_SCHM payloads, the HELLO carries the key table
+F_DELTA = "delta" # SYNC_DELTA payloads, needs F_SCHEMA
+F_RING = "ring" # UEVENTR references into a cdev.ring.EventRing, the HELLO carries its path
+F_JOURNAL = "journal" # SEQ marks and replay, the HELLO carries the journal epoch
+F_BOOTDIFF = "bootdiff" # boot against a summary of the client's devices, STALE replies
+
+FEATURES = {F_BATCH, F_SCHEMA, F_DELTA, F_RING, F_JOURNAL, F_BOOTDIFF}
+
+def pack_batch(frames):
+    """
+    Pack already packed messages into one BATCH message
+    """
+    size = sum(map(len, frames))
+    return struct.pack("!11pBQ", b"BATCH", D_DATA, size) + b"".join(frames)
+
+def unpack_batch(data):
+    """
+    Iterate the messages in the payload of a BATCH message
+    """
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        command, type, size = unpack_header(view, offset)
+        offset += 20
+        payload, fmt = deserialize_data(type, view[offset:offset+size])
+        offset += size
+        yield Message(command, type, payload, fmt)
+
+
 class Message:
     def __init__(self, command, type=D_DATA, data=b'', fmt=None):
         self.command = command
@@ -89,6 +131,69 @@ class Message:
 
     @classmethod
     def recv_from(cls, sock):
-        command, type, size = struct.unpack("!11pBQ", sock.recv(20))
-        data, fmt = deserialize_data(type, sock.recv(size))
+        command, type, size = unpack_header(_recv(sock, 20))
+        data, fmt = deserialize_data(type, _recv(sock, size))
         return cls(command, type, data, fmt)
+
+
+class Subscription:
+    """
+    The set of events a client wants, declared with its hello.
+
+    subsystems maps each wanted subsystem to a set of devtypes, or to None for
+    any devtype. subsystems=None means any subsystem.
+    tags=None means any tags, otherwise the device needs at least one of them.
+    """
+    __slots__ = ("subsystems", "tags")
+
+    def __init__(self, subsystems=None, tags=None):
+        self.subsystems = subsystems
+        self.tags = tags
+
+    def add_match(self, match):
+        """
+        Add a "subsystem[/devtype]" match, like udevadm monitor --subsystem-match
+        """
+        subsystem, _, devtype = match.partition("/")
+        if self.subsystems is None:
+            self.subsystems = {}
+        if not devtype:
+            self.subsystems[subsystem] = None
+        elif subsystem not in self.subsystems:
+            self.subsystems[subsystem] = {devtype}
+        elif self.subsystems[subsystem] is not None:
+            self.subsystems[subsystem].add(devtype)
+
+    def add_tag(self, tag):
+        if self.tags is None:
+            self.tags = set()
+        self.tags.add(tag)
+
+    def matches(self, device):
+        if self.subsystems is not None:
+            subsystem = device.get_subsystem()
+            if subsystem not in self.subsystems:
+                return False
+            devtypes = self.subsystems[subsystem]
+            if devtypes is not None and device.get_devtype() not in devtypes:
+                return False
+        if self.tags is not None and self.tags.isdisjoint(device.get_tags()):
+            return False
+        return True
+
+    def to_json(self):
+        return {
+            "subsystems": None if self.subsystems is None else {subsystem: None if devtypes is None else sorted(devtypes) for subsystem, devtypes in self.subsystems.items()},
+            "tags": None if self.tags is None else sorted(self.tags),
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        subsystems = data.get("subsystems")
+        if subsystems is not None:
+            subsystems = {subsystem: None if devtypes is None else set(devtypes) for subsystem, devtypes in subsystems.items()}
+        tags = data.get("tags")
+        return cls(subsystems, None if tags is None else set(tags))
+
+    def __repr__(self):
+        return "Subscription(%r, %r)" % (self.subsystems, self.tags)
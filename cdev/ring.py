@@ -0,0 +1,187 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+A memory-mapped ring of event buffers, written by cdevd and read by clients.
+
+Each distinct event buffer is written to the ring once. Clients get small
+references (RING_REF: position and length) over their socket and copy the
+buffer out of the ring themselves.
+
+There is a single writer. Positions are absolute byte offsets that only grow,
+the ring offset is position % capacity. The writer publishes the position
+after the last record in the header once a record is complete. A record
+whose position is more than capacity behind that has been overwritten, which
+readers check before and after copying it, with some slack for the record
+that's being written meanwhile. Records are at most that slack in size, and
+rings smaller than min_capacity are refused so the check leaves room to read.
+
+Layout:
+    header: magic, version, capacity, head (native byte order, same host)
+    records at HEADER_SIZE + offset: length, padding, data, padded to 8 bytes
+"""
+
+import os
+import mmap
+import struct
+
+MAGIC = b"CDEVRING"
+VERSION = 1
+
+header = struct.Struct("=8sIIQ")
+HEADER_SIZE = 64 # keep the data cacheline aligned
+HEAD_OFFSET = 16
+
+record = struct.Struct("=I4x")
+
+RING_REF = struct.Struct("!QI") # position, length
+
+
+class RingOverrun(Exception):
+    """
+    The record was overwritten before it could be read
+    """
+
+
+class EventRing:
+    slack = 64 * 1024 # largest record a reader expects to be in flight
+    min_capacity = 4 * slack
+
+    def __init__(self, path, map, capacity):
+        self.path = path
+        self.map = map
+        self.capacity = capacity
+
+        self.head = self.get_head()
+
+        # Buffers written recently, so each one is only written once
+        self.written = {} # id(buffer) -> (buffer, position)
+        self.max_written = 1024
+
+    @classmethod
+    def create(cls, path, capacity):
+        """
+        Create a new ring file at path, replacing an existing one
+        """
+        capacity = (capacity + 7) & ~7
+        if capacity < cls.min_capacity:
+            raise ValueError("Event ring of %i bytes is smaller than the minimum of %i" % (capacity, cls.min_capacity))
+        tmp_path = path + ".new"
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, HEADER_SIZE + capacity)
+            map = mmap.mmap(fd, HEADER_SIZE + capacity)
+        finally:
+            os.close(fd)
+        header.pack_into(map, 0, MAGIC, VERSION, capacity, 0)
+        os.rename(tmp_path, path)
+        return cls(path, map, capacity)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Open an existing ring file for reading
+        """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            map = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        magic, version, capacity, head = header.unpack_from(map, 0)
+        if magic != MAGIC or version != VERSION:
+            map.close()
+            raise ValueError("Not a cdev event ring: %s" % path)
+        if capacity < cls.min_capacity:
+            map.close()
+            raise ValueError("Event ring is too small: %s" % path)
+        return cls(path, map, capacity)
+
+    def close(self, unlink=False):
+        self.map.close()
+        if unlink:
+            os.unlink(self.path)
+
+    def get_head(self):
+        return struct.unpack_from("=Q", self.map, HEAD_OFFSET)[0]
+
+    # Writing
+    def put(self, buffer):
+        """
+        Write buffer to the ring, returns its position.
+
+        Raises ValueError for buffers larger than the slack readers allow
+        for, send those some other way.
+        """
+        size = record.size + ((len(buffer) + 7) & ~7)
+        if size > self.slack:
+            raise ValueError("Buffer of %i bytes is too large for the ring" % len(buffer))
+
+        # Records don't wrap around, skip the rest of the ring instead
+        offset = self.head % self.capacity
+        if offset + size > self.capacity:
+            self.head += self.capacity - offset
+            offset = 0
+
+        position = self.head
+        start = HEADER_SIZE + offset
+        record.pack_into(self.map, start, len(buffer))
+        self.map[start + record.size:start + record.size + len(buffer)] = buffer
+
+        # Publish
+        self.head += size
+        struct.pack_into("=Q", self.map, HEAD_OFFSET, self.head)
+        return position
+
+    def put_once(self, buffer):
+        """
+        Like put(), but the same buffer object is only written once while it's recent
+        """
+        entry = self.written.get(id(buffer))
+        if entry is not None and entry[0] is buffer and self.head - entry[1] <= self.capacity // 2:
+            return entry[1]
+
+        if len(self.written) >= self.max_written:
+            self.written.clear()
+
+        position = self.put(buffer)
+        self.written[id(buffer)] = (buffer, position)
+        return position
+
+    # Reading
+    def is_overrun(self, position):
+        # Leave room for a record the writer may be writing right now
+        return self.get_head() - position > self.capacity - self.slack
+
+    def get(self, position, length):
+        """
+        Copy a record out of the ring, raises RingOverrun if it was overwritten
+        """
+        if self.is_overrun(position):
+            raise RingOverrun(position)
+
+        start = HEADER_SIZE + position % self.capacity
+        if record.unpack_from(self.map, start)[0] != length:
+            raise RingOverrun(position)
+        data = self.map[start + record.size:start + record.size + length]
+
+        # The writer may have caught up while we were copying
+        if self.is_overrun(position):
+            raise RingOverrun(position)
+        return data
@@ -83,15 +83,28 @@ class _Condition:
     A condition consists of a lvalue, an operation and a rvalue.
     The lvalue needs to be computed
     """
-    __slots__ = ("operation", "rvalue")
+    __slots__ = ("operation", "rvalue", "pattern")
 
     def __init__(self, operation, rvalue):
+        # Keep the uncompiled value around for static analysis of rules
+        self.pattern = rvalue
+
         if hasattr(operation, "compile"):
             rvalue = operation.compile(rvalue)
 
         self.operation = operation
         self.rvalue = rvalue
 
+    def literals(self):
+        """
+        Get the set of lvalues this condition can possibly be true for.
+        Returns None if that set is unknown or unbounded.
+        """
+        if self.operation is op_equals:
+            return {self.pattern}
+        elif self.operation is op_fnmatches:
+            return fnmatch.literals(self.pattern)
+
     def __call__(self, context):
         return self.operation(self.lvalue(context.device), self.rvalue)
 
@@ -441,6 +454,32 @@ class RuleSet(list):
                 rulenr += 1
 
 
+def interesting_subsystems(ruleset, has_effect):
+    """
+    Conservatively compute the set of SUBSYSTEM values for which ruleset can
+    have an effect. has_effect(item) tells which rule items count as one.
+
+    Returns None if any subsystem may be interesting.
+    """
+    subsystems = set()
+
+    for rule in ruleset:
+        # Conditions only constrain the assignments following them in the same rule
+        constraint = None
+        for cond in rule:
+            if type(cond) is PropertyCondition and cond.lvalue_source == "SUBSYSTEM":
+                values = cond.literals()
+                if values is not None:
+                    constraint = values if constraint is None else constraint & values
+
+            elif has_effect(cond):
+                if constraint is None:
+                    return None
+                subsystems |= constraint
+
+    return subsystems
+
+
 # -----------------------------------------------------------------------------
 # Parsing helpers
 def fill_syntax_error(se, filename, lineno, offset=0, text=None):
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Compact binary encoding for structured cdev protocol payloads (D_SCHM).
+
+A payload is a schema id byte, a header with the integers and element counts
+of the schema's fields in order, so field names are never sent, and then all strings
+in one NUL-separated UTF-8 blob that's decoded and split at once.
+
+The dictionary keys of STRMAP fields are looked up in a key table that both
+sides agree on in the HELLO handshake; keys in the table are sent as one byte
+in the header, others at the end of the blob.
+
+Strings must not contain NUL, which holds for everything that comes from
+uevents or the udev db.
+"""
+
+import itertools
+import operator
+
+# Field kinds
+INT = "int"         # a non-negative integer, in the header
+STR = "str"         # a string
+STRMAP = "strmap"   # a {str: str} dict
+STRLIST = "strlist" # a list of strings
+
+
+def _pack_varint(out, value):
+    while value > 0x7f:
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    out.append(value)
+
+def _unpack_varint(data, offset):
+    if data[offset] < 0x80:
+        return data[offset], offset + 1
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def _pack_blob(out, blob):
+    _pack_varint(out, len(blob))
+    out += blob
+
+def _unpack_str(data, offset):
+    size, offset = _unpack_varint(data, offset)
+    return str(data[offset:offset+size], "utf-8"), offset + size
+
+
+class Schema:
+    """
+    The field layout of one kind of payload
+    """
+    __slots__ = ("id", "name", "fields")
+
+    def __init__(self, id, name, *fields):
+        self.id = id
+        self.name = name
+        self.fields = fields # (name, kind)
+
+    def __repr__(self):
+        return "Schema(%i, %r)" % (self.id, self.name)
+
+
+schemas = {}
+
+def register(schema):
+    schemas[schema.id] = schema
+    return schema
+
+
+SYNC = register(Schema(1, "sync", ("devpath", STR), ("props", STR), ("env", STRMAP), ("tags", STRLIST), ("version", INT)))
+
+# Changes since the SYNC or SYNC_DELTA with version base
+SYNC_DELTA = register(Schema(2, "sync_delta", ("devpath", STR), ("props", STR), ("base", INT), ("version", INT),
+                             ("env", STRMAP), ("unset", STRLIST), ("tags", STRLIST), ("untag", STRLIST)))
+
+
+# Default key table, the most common udev properties.
+# Ids are one byte, so at most 255 keys.
+KEYS = (
+    "ACTION", "DEVPATH", "SUBSYSTEM", "DEVNAME", "DEVTYPE", "SEQNUM", "MAJOR", "MINOR",
+    "DRIVER", "IFINDEX", "INTERFACE", "MODALIAS", "PRODUCT", "TYPE", "BUSNUM", "DEVNUM",
+    "DEVLINKS", "TAGS", "USEC_INITIALIZED", "SYSTEMD_WANTS", "SYSTEMD_ALIAS", "SYSTEMD_READY",
+    "ID_BUS", "ID_MODEL", "ID_MODEL_ENC", "ID_MODEL_ID", "ID_MODEL_FROM_DATABASE",
+    "ID_VENDOR", "ID_VENDOR_ENC", "ID_VENDOR_ID", "ID_VENDOR_FROM_DATABASE",
+    "ID_SERIAL", "ID_SERIAL_SHORT", "ID_REVISION", "ID_TYPE", "ID_PATH", "ID_PATH_TAG",
+    "ID_USB_DRIVER", "ID_USB_INTERFACES", "ID_USB_INTERFACE_NUM", "ID_USB_CLASS_FROM_DATABASE",
+    "ID_PCI_CLASS_FROM_DATABASE", "ID_PCI_SUBCLASS_FROM_DATABASE", "ID_PCI_INTERFACE_FROM_DATABASE",
+    "ID_INSTANCE", "ID_PART_TABLE_TYPE", "ID_PART_TABLE_UUID", "ID_PART_ENTRY_SCHEME",
+    "ID_PART_ENTRY_TYPE", "ID_PART_ENTRY_NUMBER", "ID_PART_ENTRY_OFFSET", "ID_PART_ENTRY_SIZE",
+    "ID_PART_ENTRY_DISK", "ID_PART_ENTRY_UUID", "ID_PART_ENTRY_NAME", "ID_FS_TYPE", "ID_FS_USAGE",
+    "ID_FS_UUID", "ID_FS_UUID_ENC", "ID_FS_LABEL", "ID_FS_LABEL_ENC", "ID_FS_VERSION",
+    "ID_ATA", "ID_ATA_SATA", "ID_WWN", "ID_WWN_WITH_EXTENSION", "ID_SCSI", "ID_SCSI_SERIAL",
+    "ID_INPUT", "ID_INPUT_KEY", "ID_INPUT_KEYBOARD", "ID_INPUT_MOUSE", "ID_INPUT_TOUCHPAD",
+    "ID_NET_NAME", "ID_NET_NAME_MAC", "ID_NET_NAME_PATH", "ID_NET_NAME_SLOT", "ID_NET_DRIVER",
+    "ID_NET_LINK_FILE", "ID_MM_CANDIDATE", "ID_FOR_SEAT", "ID_SEAT", "ID_V4L_VERSION",
+    "ID_V4L_PRODUCT", "ID_V4L_CAPABILITIES", "SOUND_INITIALIZED", "SOUND_FORM_FACTOR",
+    "COLOR", "MAJOR_MINOR", "DM_NAME", "DM_UUID", "DM_SUSPENDED", "NAME", "PHYS", "UNIQ",
+    "PROP", "EV", "KEY", "MSC", "LED", "REL", "ABS", "SW", "FF", "HID_ID", "HID_NAME",
+    "HID_PHYS", "HID_UNIQ", "PCI_CLASS", "PCI_ID", "PCI_SUBSYS_ID", "PCI_SLOT_NAME",
+    "PARTN", "PARTNAME", "DISKSEQ", "NR_PARTITIONS", "UDISKS_IGNORE", "UDISKS_PRESENTATION_HIDE",
+)
+
+
+class Codec:
+    """
+    Encodes and decodes D_SCHM payloads with one connection's key table
+    """
+    __slots__ = ("keys", "index")
+
+    def __init__(self, keys=KEYS):
+        if len(keys) > 255:
+            raise ValueError("Key table can't hold more than 255 keys")
+        self.keys = (None,) + tuple(keys)
+        self.index = {key: i for i, key in enumerate(self.keys) if i}
+
+    def encode(self, schema, values):
+        """
+        Encode the values dict according to schema
+        """
+        out = bytearray((schema.id,))
+        strings = []
+        inline = []
+        for name, kind in schema.fields:
+            value = values[name]
+            if kind == INT:
+                _pack_varint(out, value)
+            elif kind == STR:
+                strings.append(value)
+            elif kind == STRMAP:
+                _pack_varint(out, len(value))
+                ids = bytes(map(self.index.get, value, itertools.repeat(0)))
+                out += ids
+                strings.extend(value.values())
+                if 0 in ids:
+                    inline.extend(key for key in value if key not in self.index)
+            elif kind == STRLIST:
+                _pack_varint(out, len(value))
+                strings.extend(value)
+            else:
+                raise TypeError("Unknown field kind %s" % kind)
+        strings.extend(inline)
+        _pack_blob(out, "\0".join(strings).encode())
+        return bytes(out)
+
+    def decode(self, data):
+        """
+        Returns the schema and values dict of a payload
+        """
+        schema = schemas[data[0]]
+        offset = 1
+
+        # The header: integers, counts and key ids
+        layout = [] # (name, kind, number of strings, integer value or key ids)
+        for name, kind in schema.fields:
+            if kind == INT:
+                value, offset = _unpack_varint(data, offset)
+                layout.append((name, kind, 0, value))
+            elif kind == STR:
+                layout.append((name, kind, 1, None))
+            else:
+                count, offset = _unpack_varint(data, offset)
+                if kind == STRMAP:
+                    layout.append((name, kind, count, bytes(data[offset:offset+count])))
+                    offset += count
+                else:
+                    layout.append((name, kind, count, None))
+
+        strings, offset = _unpack_str(data, offset)
+        strings = strings.split("\0")
+
+        values = {}
+        pos = 0
+        inline = sum(entry[2] for entry in layout) # inline keys follow all other strings
+        for name, kind, count, extra in layout:
+            if kind == INT:
+                values[name] = extra
+            elif kind == STR:
+                values[name] = strings[pos]
+            elif kind == STRMAP:
+                ids = extra
+                if not count:
+                    keys = ()
+                elif count > 1:
+                    keys = operator.itemgetter(*ids)(self.keys)
+                else:
+                    keys = (self.keys[ids[0]],)
+
+                # Fill in the keys that were sent inline
+                i = ids.find(0) if count else -1
+                if i >= 0:
+                    keys = list(keys)
+                    while i >= 0:
+                        keys[i] = strings[inline]
+                        inline += 1
+                        i = ids.find(0, i + 1)
+                values[name] = dict(zip(keys, strings[pos:pos+count]))
+            else:
+                values[name] = strings[pos:pos+count]
+            pos += count
+        return schema, values
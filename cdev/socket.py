@@ -24,11 +24,14 @@ Helpers for working with sockets
 * defines the NETLINK_* constants
 * adds a ucred structure (see cdev.struct)
 * adds getpeercred()
+* adds helpers for passing file descriptors with SCM_RIGHTS
 """
 
 from socket import *
 from . import struct
 
+import array
+
 # -----------------------------------------------------------------------------
 # NETLINK protocol constants (from linux/netlink.h)
 NETLINK_ROUTE           = 0 # Routing/device hook
@@ -53,6 +56,13 @@ NETLINK_SCSITRANSPORT   = 18 # SCSI Transport
 NETLINK_ECRYPTFS        = 19
 
 
+# Not all python versions export it (from asm-generic/socket.h)
+try:
+    SO_RCVBUFFORCE
+except NameError:
+    SO_RCVBUFFORCE = 33
+
+
 # -----------------------------------------------------------------------------
 # credentials passing with SO_PEERCRED
 class ucred(struct.FrozenStruct):
@@ -65,3 +75,22 @@ def getpeercred(sock):
     return ucred.unpack(peercred)
 
 socket.getpeercred = getpeercred
+
+
+# -----------------------------------------------------------------------------
+# file descriptor passing with SCM_RIGHTS
+def fds_ancdata(fds):
+    """
+    Make the sendmsg() ancillary data to pass fds
+    """
+    return [(SOL_SOCKET, SCM_RIGHTS, array.array("i", fds))]
+
+def fds_from_ancdata(ancdata):
+    """
+    Collect the fds received with recvmsg()
+    """
+    fds = array.array("i")
+    for level, type, data in ancdata:
+        if level == SOL_SOCKET and type == SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    return list(fds)
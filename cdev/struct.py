@@ -37,10 +37,15 @@ class MyStruct(cdev.struct.MixStruct):
 There also are Frozen(Mix)Struct classes that use a tuple for storage instead of a list
 
 All (Frozen)(Mix)Struct types use __slots__.
+
+Fields are accessed through generated descriptors, and every struct type gets
+specialized pack(), pack_into() and unpack_from() functions, so a message
+header costs about as much as a plain struct.Struct call.
 """
 
+import re
 import struct
-from itertools import chain
+from operator import itemgetter
 
 # Import a few functions
 calcsize = struct.calcsize
@@ -77,8 +82,51 @@ def calccount(fmt):
     return cnt
 
 
+def calcoffsets(fmt):
+    """
+    Calculate the byte offset of every item in a format string
+    """
+    byteorder = fmt[0] if fmt and fmt[0] in "@=<>!" else ""
+    prefix = byteorder
+    offsets = []
+
+    for count, code in re.findall(r"(\d*)([a-zA-Z?])", fmt):
+        count = int(count) if count else 1
+        if code == "x":
+            prefix += "%ix" % count
+        elif code in "sp":
+            offsets.append(struct.calcsize(prefix + code) - struct.calcsize(byteorder + code))
+            prefix += "%i%s" % (count, code)
+        else:
+            for i in range(count):
+                offsets.append(struct.calcsize(prefix + code) - struct.calcsize(byteorder + code))
+                prefix += code
+    return offsets
+
+
+def _field(index, name, mutable):
+    """
+    Make a descriptor for the item at index
+    """
+    if mutable:
+        def set(self, value):
+            self[index] = value
+    else:
+        set = None
+    return property(itemgetter(index), set, doc="Struct field '%s'" % name)
+
+
+def _compile(name, source, namespace):
+    exec(compile(source, "<cdev.struct %s>" % name, "exec"), namespace)
+    return namespace[name]
+
+
 # extended Struct type
 class StructType(type):
+    def __new__(mcls, name, bases, body):
+        body.setdefault("__slots__", ())
+        return super().__new__(mcls, name, bases, body)
+
     def __init__(cls, name, bases, body):
         super().__init__(name, bases, body)
 
@@ -86,6 +134,12 @@ class StructType(type):
         names = body["names"]
         cls._namemap = {n:i for i,n in enumerate(names)}
 
+        # Generate field accessors, but don't shadow anything else
+        mutable = issubclass(cls, list)
+        for i, n in enumerate(names):
+            if not hasattr(cls, n):
+                setattr(cls, n, _field(i, n, mutable))
+
         # Skip if we got a MixStruct
         if type(cls) is not StructType:
             return
@@ -98,28 +152,70 @@ class StructType(type):
         cls.size = cls._struct.size
 
         if len(names) != cls._totalct:
-            raise TypeError("Struct holds %i items, but %i names were specified!" % (cls._itemcnt, len(names)))
+            raise TypeError("Struct holds %i items, but %i names were specified!" % (cls._totalct, len(names)))
+
+        cls._fieldoff = dict(zip(names, calcoffsets(format)))
+
+        # A plain struct is a MixStruct with a single part
+        cls._structs = cls._struct,
+        cls._offsets = 0,
+        cls._itemoff = 0,
+        cls._itemcnt = cls._totalct,
+
+        cls._generate()
+
+    def _generate(cls):
+        """
+        Generate specialized pack(), pack_into() and unpack_from() functions
+        that call each part's struct directly, without any intermediate iterables.
+        """
+        namespace = {}
+        packs = []
+        pack_intos = []
+        unpacks = []
+
+        for i, (s, offset, start, count) in enumerate(zip(cls._structs, cls._offsets, cls._itemoff, cls._itemcnt)):
+            namespace["_pack%i" % i] = s.pack
+            namespace["_pack_into%i" % i] = s.pack_into
+            namespace["_unpack_from%i" % i] = s.unpack_from
+
+            items = "".join(", self[%i]" % j for j in range(start, start + count))
+            packs.append("_pack%i(%s)" % (i, items[2:]))
+            pack_intos.append("    _pack_into%i(buffer, offset + %i%s)\n" % (i, offset, items))
+            unpacks.append("_unpack_from%i(buffer, offset + %i)" % (i, offset))
+
+        cls.pack = _compile("pack", "def pack(self):\n    return %s\n" % (" + ".join(packs) or "b''"), namespace)
+        cls.pack_into = _compile("pack_into", "def pack_into(self, buffer, offset=0):\n%s    pass\n" % "".join(pack_intos), namespace)
+        # The format guarantees the item count, so skip __init__()
+        values = " + ".join(unpacks) or "()"
+        if issubclass(cls, list):
+            namespace["_new"] = list.__new__
+            namespace["_extend"] = list.extend
+            source = "def unpack_from(cls, buffer, offset=0):\n    self = _new(cls)\n    _extend(self, %s)\n    return self\n" % values
+        else:
+            namespace["_new"] = tuple.__new__
+            source = "def unpack_from(cls, buffer, offset=0):\n    return _new(cls, %s)\n" % values
+        unpack_from = _compile("unpack_from", source, namespace)
+        cls.unpack_from = classmethod(unpack_from)
+
+        namespace["_error"] = struct.error
+        cls.unpack = classmethod(_compile("unpack", "def unpack(cls, buffer):\n    if len(buffer) != %i:\n        raise _error('unpack requires a buffer of %i bytes')\n    return unpack_from(cls, buffer)\n" % (cls.size, cls.size), namespace))
+
+    def offsetof(cls, name):
+        """
+        Get the byte offset of a field
+        """
+        return cls._fieldoff[name]
 
 
 class _StructBase:
     __slots__ = ()
 
     def __getattr__(self, name):
-        if name in self.names:
-            return self[self._namemap[name]]
-        else:
-            raise AttributeError("Struct %s has no member '%s'" % (type(self).__name__, name))
-
-    def pack(self):
-        return self._struct.pack(self)
+        # Only called for names that aren't fields, see StructType
+        raise AttributeError("Struct %s has no member '%s'" % (type(self).__name__, name))
 
-    @classmethod
-    def unpack_from(cls, buffer, offset=0):
-        return cls(cls._struct.unpack_from(buffer, offset))
-
-    @classmethod
-    def unpack(cls, buffer):
-        return cls(cls._struct.unpack(buffer))
+    # pack(), pack_into(), unpack() and unpack_from() are generated by StructType._generate()
 
 
 class FrozenStruct(_StructBase, tuple, metaclass=StructType):
@@ -144,11 +240,7 @@ class Struct(_StructBase, list, metaclass=StructType):
         if len(self) != self._totalct:
             raise TypeError("Size of struct %s is %i, tried to initialize with %i items" % (type(self).__name__, self._totalct, len(self)))
 
-    def __setattr__(self, name, value):
-        if name in self.names:
-            self[self._namemap[name]] = value
-        else:
-            raise AttributeError("Struct %s has no member '%s'" % (type(self).__name__, name))
+    # Fields are assigned through the generated descriptors
 
     format = ""
     names = ()
@@ -180,22 +272,15 @@ class MixStructType(StructType):
         #print(formats, cls._itemcnt, cls._itemoff, len(names))
 
         if len(cls.names) != cls._totalct:
-            raise TypeError("Struct holds %i items, but %i names were specified!" % (cls._totalct, len(names)))
+            raise TypeError("Struct holds %i items, but %i names were specified!" % (cls._totalct, len(cls.names)))
 
+        cls._fieldoff = dict(zip(cls.names, (offset + item_offset for offset, format in zip(cls._offsets, formats) for item_offset in calcoffsets(format))))
 
-class _MixStructBase:
-    __slots__ = ()
+        cls._generate()
 
-    def pack(self):
-        return b"".join(self._structs[i].pack(*self[self._itemoff[i]:self._itemoff[i]+self._itemcnt[i]]) for i in range(len(self._structs)))
 
-    @classmethod
-    def unpack_from(cls, buffer, offset=0):
-        return cls(chain.from_iterable(cls._structs[i].unpack_from(buffer, offset+cls._offsets[i]) for i in range(len(cls._structs))))
-
-    @classmethod
-    def unpack(cls, buffer):
-        return cls(chain.from_iterable(cls._structs[i].unpack_from(buffer, cls._offsets[i]) for i in range(len(cls._structs))))
+class _MixStructBase:
+    __slots__ = ()
 
 
 class FrozenMixStruct(_MixStructBase, FrozenStruct, metaclass=MixStructType):
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+Check cdev.cgroups.ControlGroupManager with the cgroupfs manager writing to
+a temporary directory that stands in for /sys/fs/cgroup/devices.
+"""
+
+import os
+import sys
+import asyncio
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if not hasattr(asyncio, "coroutine"):
+    raise unittest.SkipTest("cdev needs asyncio.coroutine")
+
+import cdev.asyncio
+import cdev.cgroups
+import cdev.device
+
+
+def make_device(name, major, minor, subsystem="tty"):
+    return cdev.device.Device.from_props({"DEVPATH": "/devices/test/%s" % name, "SUBSYSTEM": subsystem,
+                                          "MAJOR": str(major), "MINOR": str(minor), "DEVNAME": name})
+
+
+class ControlGroupManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.tmp.name, "ct"))
+        for file in ("devices.allow", "devices.deny"):
+            open(os.path.join(self.tmp.name, "ct", file), "w").close()
+        self.cgroupfs_path = cdev.cgroups.CGROUPFS_PATH
+        cdev.cgroups.CGROUPFS_PATH = os.path.join(self.tmp.name, "%s")
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        # A manager of our own, so the counters start at 0
+        self.batches = []
+        self.fail = 0
+        self.manager = cdev.cgroups.ControlGroupManager(self.id())
+        self.manager.retry_delay = 0.01
+        self.manager(self.update)
+
+    def tearDown(self):
+        del cdev.cgroups.ControlGroupManager.registry[self.manager.name]
+        cdev.cgroups.CGROUPFS_PATH = self.cgroupfs_path
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        self.tmp.cleanup()
+
+    def update(self, container_name, updates):
+        self.batches.append(list(updates))
+        if self.fail:
+            self.fail -= 1
+            raise OSError("cgroup is busy")
+        cdev.cgroups.cgroupfs_update(container_name, updates)
+
+    def read(self, file):
+        with open(os.path.join(self.tmp.name, "ct", file)) as f:
+            return f.read()
+
+    def run_until_applied(self, *futures):
+        futures = [future for future in futures if future is not None]
+        if futures:
+            self.loop.run_until_complete(asyncio.wait(futures))
+        self.loop.run_until_complete(self.manager.drain())
+        return [future.result() for future in futures]
+
+    def test_allow_deny(self):
+        usb = make_device("usb", 189, 1, "usb")
+        self.assertEqual(self.run_until_applied(self.manager.allow("ct", usb)), [True])
+        self.assertEqual(self.read("devices.allow"), "c 189:1 rwm")
+
+        self.assertEqual(self.run_until_applied(self.manager.deny("ct", make_device("sda", 8, 0, "block"))), [True])
+        self.assertEqual(self.read("devices.deny"), "b 8:0 rm")
+
+    def test_repeated_rule_skipped(self):
+        tty = make_device("tty1", 4, 1)
+        self.run_until_applied(self.manager.allow("ct", tty))
+        self.assertIsNone(self.manager.allow("ct", tty))
+        self.run_until_applied()
+        self.assertEqual(self.batches, [[("devices.allow", "c 4:1 rwm")]])
+        self.assertEqual(self.manager.deduplicated.value, 1)
+
+        # Unless the container was forgotten
+        self.manager.forget("ct")
+        self.run_until_applied(self.manager.allow("ct", tty))
+        self.assertEqual(len(self.batches), 2)
+
+    def test_pending_rule_replaced(self):
+        tty = make_device("tty1", 4, 1)
+        allowed = self.manager.allow("ct", tty)
+        denied = self.manager.deny("ct", tty)
+        self.assertIs(allowed, denied)
+        self.run_until_applied(denied)
+        self.assertEqual(self.batches, [[("devices.deny", "c 4:1 rm")]])
+
+    def test_batches_in_order(self):
+        devices = [make_device("tty%i" % i, 4, i) for i in range(8)]
+        futures = [self.manager.allow("ct", device) for device in devices]
+        self.run_until_applied(*futures)
+        self.assertEqual(self.batches, [[("devices.allow", "c 4:%i rwm" % i) for i in range(8)]])
+
+    def test_failed_batch_retried(self):
+        self.fail = 1
+        future = self.manager.allow("ct", make_device("tty1", 4, 1))
+        self.assertEqual(self.run_until_applied(future), [True])
+        self.assertEqual(len(self.batches), 2)
+        self.assertEqual(self.manager.retries.value, 1)
+        self.assertEqual(self.read("devices.allow"), "c 4:1 rwm")
+
+    def test_failed_batch_given_up(self):
+        self.fail = self.manager.max_attempts
+        tty = make_device("tty1", 4, 1)
+        self.assertEqual(self.run_until_applied(self.manager.allow("ct", tty)), [False])
+        self.assertEqual(len(self.batches), self.manager.max_attempts)
+        self.assertEqual(self.read("devices.allow"), "")
+
+        # It's not skipped as a duplicate next time
+        self.assertEqual(self.run_until_applied(self.manager.allow("ct", tty)), [True])
+        self.assertEqual(self.read("devices.allow"), "c 4:1 rwm")
+
+    def test_future_done_after_write(self):
+        writing = threading.Event()
+        proceed = threading.Event()
+
+        def update(container_name, updates):
+            writing.set()
+            proceed.wait(5)
+            cdev.cgroups.cgroupfs_update(container_name, updates)
+        self.manager(update)
+
+        future = self.manager.allow("ct", make_device("tty1", 4, 1))
+        self.loop.run_until_complete(self.loop.run_in_executor(None, writing.wait, 5))
+        self.assertFalse(future.done())
+        self.assertIs(self.manager.allow("ct", make_device("tty1", 4, 1)), future)
+
+        proceed.set()
+        self.assertEqual(self.run_until_applied(future), [True])
+        self.assertEqual(self.read("devices.allow"), "c 4:1 rwm")
+
+    def test_queue_held_until_applied(self):
+        # What cdevd does with the grant of a device it's about to send
+        proceed = threading.Event()
+
+        def update(container_name, updates):
+            proceed.wait(5)
+            cdev.cgroups.cgroupfs_update(container_name, updates)
+        self.manager(update)
+
+        writer = Writer()
+        queue = cdev.asyncio.MessageQueue(writer, name="test.queue", loop=self.loop)
+        queue.put(b"before")
+        grant = self.manager.allow("ct", make_device("tty1", 4, 1))
+        queue.hold(grant)
+        queue.put(b"UEVENT add tty1")
+
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(writer.written, [b"before"])
+
+        proceed.set()
+        self.run_until_applied(grant)
+        queue.close()
+        self.loop.run_until_complete(queue.task)
+        self.assertEqual(writer.written, [b"before", b"UEVENT add tty1"])
+        self.assertEqual(self.read("devices.allow"), "c 4:1 rwm")
+
+
+class Writer:
+    """
+    Collects what a MessageQueue writes
+    """
+    transport = None
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, buffer):
+        self.written.append(buffer)
+
+    @asyncio.coroutine
+    def drain(self):
+        yield from asyncio.sleep(0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+Check cdev.netlink.PropertyBuffer, the lazily decoded property mapping.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cdev.netlink import PropertyBuffer
+
+
+BUFFER = b"ACTION=add\0DEVPATH=/devices/x\0SUBSYSTEM=usb\0FOO=1"
+
+
+class PropertyBufferTest(unittest.TestCase):
+    def test_lookup(self):
+        p = PropertyBuffer(BUFFER)
+        self.assertEqual(p["SUBSYSTEM"], "usb")
+        self.assertEqual(p["FOO"], "1")
+        self.assertNotIn("BAR", p)
+        self.assertFalse(p.modified)
+
+    def test_delete_after_len(self):
+        p = PropertyBuffer(BUFFER)
+        self.assertEqual(len(p), 4)
+        del p["FOO"]
+        self.assertNotIn("FOO", p)
+        self.assertEqual(len(p), 3)
+        self.assertTrue(p.modified)
+        with self.assertRaises(KeyError):
+            del p["FOO"]
+
+    def test_delete_after_iteration(self):
+        p = PropertyBuffer(BUFFER)
+        self.assertEqual(list(p), ["ACTION", "DEVPATH", "SUBSYSTEM", "FOO"])
+        del p["DEVPATH"]
+        self.assertEqual(list(p), ["ACTION", "SUBSYSTEM", "FOO"])
+
+    def test_hide_after_iteration(self):
+        p = PropertyBuffer(BUFFER)
+        list(p)
+        self.assertEqual(p.hide("FOO"), "1")
+        self.assertEqual(p.materialize(), {"ACTION": "add", "DEVPATH": "/devices/x", "SUBSYSTEM": "usb"})
+        self.assertFalse(p.modified)
+        self.assertIsNone(p.hide("FOO"))
+
+    def test_hide_after_len(self):
+        p = PropertyBuffer(BUFFER)
+        len(p)
+        self.assertEqual(p.hide("ACTION"), "add")
+        self.assertNotIn("ACTION", p)
+        self.assertEqual(len(p), 3)
+
+    def test_set_after_len(self):
+        p = PropertyBuffer(BUFFER)
+        len(p)
+        p["FOO"] = "2"
+        p["BAR"] = "3"
+        self.assertEqual(p["FOO"], "2")
+        self.assertEqual(len(p), 5)
+        self.assertTrue(p.modified)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+Check cdev.ring.EventRing with a ring file in a temporary directory.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cdev.ring import EventRing, RingOverrun
+
+
+class EventRingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "events.ring")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        writer = EventRing.create(self.path, EventRing.min_capacity)
+        reader = EventRing.open(self.path)
+        try:
+            positions = [(writer.put(b"event %i" % i), b"event %i" % i) for i in range(100)]
+            for position, buffer in positions:
+                self.assertEqual(reader.get(position, len(buffer)), buffer)
+        finally:
+            reader.close()
+            writer.close(unlink=True)
+
+    def test_small_ring_refused(self):
+        with self.assertRaises(ValueError):
+            EventRing.create(self.path, 4096)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_large_record_refused(self):
+        writer = EventRing.create(self.path, EventRing.min_capacity)
+        try:
+            with self.assertRaises(ValueError):
+                writer.put(b"x" * EventRing.slack)
+        finally:
+            writer.close(unlink=True)
+
+    def test_overrun(self):
+        writer = EventRing.create(self.path, EventRing.min_capacity)
+        reader = EventRing.open(self.path)
+        try:
+            buffer = b"x" * 1000
+            first = writer.put(buffer)
+            while writer.head - first <= writer.capacity:
+                writer.put(buffer)
+            with self.assertRaises(RingOverrun):
+                reader.get(first, len(buffer))
+            last = writer.put(buffer)
+            self.assertEqual(reader.get(last, len(buffer)), buffer)
+        finally:
+            reader.close()
+            writer.close(unlink=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
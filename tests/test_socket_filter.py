@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# cdev -- A device management/hotplug daemon for container environments.
+#
+# Copyright (c) 2014 Taeyeon Mori
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Check the netlink socket filter cdevd derives from filter rulesets.
+
+A datagram socketpair stands in for the netlink socket: the filter is
+attached to the receiving end, packed libudev messages are sent through it
+and we look at what arrives.
+"""
+
+import os
+import sys
+import socket
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdev.bpf
+import cdev.fnmatch
+import cdev.netlink
+import cdev.filter_rules
+
+
+def parse_rules(text):
+    with tempfile.NamedTemporaryFile("w", suffix=".rules", delete=False) as f:
+        f.write(text)
+    try:
+        return cdev.filter_rules.RulesPreset.parse(f.name)
+    finally:
+        os.unlink(f.name)
+
+
+def udev_message(subsystem, devtype=None):
+    props = {"ACTION": "add", "DEVPATH": "/devices/test/%s" % subsystem, "SUBSYSTEM": subsystem}
+    if devtype is not None:
+        props["DEVTYPE"] = devtype
+    return cdev.netlink.UdevNetlinkMessage.from_props(props).pack()
+
+
+class SocketFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.rsock, self.wsock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.rsock.setblocking(False)
+
+    def tearDown(self):
+        self.rsock.close()
+        self.wsock.close()
+
+    def attach(self, rules):
+        subsystems = cdev.filter_rules.interesting_subsystems(parse_rules(rules))
+        self.assertIsNotNone(subsystems)
+        cdev.bpf.attach_filter(self.rsock, cdev.netlink.udev_monitor_filter(subsystems))
+        return subsystems
+
+    def passes(self, buffer):
+        self.wsock.send(buffer)
+        try:
+            return self.rsock.recv(65536) == buffer
+        except BlockingIOError:
+            return False
+
+    def test_subsystems(self):
+        self.attach('SUBSYSTEM=="usb|block", TARGET="allow"\n'
+                    'SUBSYSTEM=="input", TARGET="deny"\n')
+
+        self.assertTrue(self.passes(udev_message("usb")))
+        self.assertTrue(self.passes(udev_message("block", "disk")))
+        self.assertFalse(self.passes(udev_message("input")))
+        self.assertFalse(self.passes(udev_message("usbmisc")))
+        self.assertFalse(self.passes(udev_message("tty")))
+
+    def test_kernel_messages_pass(self):
+        self.attach('SUBSYSTEM=="usb", TARGET="allow"\n')
+
+        self.assertTrue(self.passes(b"add@/devices/test/tty\0ACTION=add\0DEVPATH=/devices/test/tty\0SUBSYSTEM=tty\0"))
+
+    def test_cenv_is_an_effect(self):
+        self.assertEqual(self.attach('SUBSYSTEM=="tty", CENV{seen}="1"\n'), {"tty"})
+        self.assertTrue(self.passes(udev_message("tty")))
+
+    def test_unconstrained(self):
+        ruleset = parse_rules('SUBSYSTEM=="usb*", TARGET="allow"\n')
+        self.assertIsNone(cdev.filter_rules.interesting_subsystems(ruleset))
+
+    def test_alternatives_match_whole_values(self):
+        # The filter passes exactly the literals, so the rule must not match more than them
+        self.assertEqual(cdev.fnmatch.literals("usb|block"), {"usb", "block"})
+        self.assertTrue(cdev.fnmatch.match("block", "usb|block"))
+        self.assertFalse(cdev.fnmatch.match("usbmisc", "usb|block"))
+        self.assertFalse(cdev.fnmatch.match("xblock", "usb|block"))
+
+
+if __name__ == "__main__":
+    unittest.main()